@@ -5,10 +5,13 @@
 from buildbot.plugins import *
 
 from yoctoabb import config
+from yoctoabb.lib import buildhistory, diskusage, quarantine, requestindex, workerresources, workerselection
 from yoctoabb.steps.writelayerinfo import WriteLayerInfo
-from yoctoabb.steps.runconfig import get_publish_dest, get_publish_resultdir, get_publish_name, RunConfigCheckSteps, TargetPresent
+from yoctoabb.steps.helpermirror import get_helper_bundle, PinHelperRevision
+from yoctoabb.steps.sharedrepos import get_sharedrepo_remove, AcquireSharedRepos, MarkSharedReposReady, ReleaseSharedRepos
+from yoctoabb.steps.runconfig import get_publish_dest, get_publish_resultdir, get_publish_name, get_parent_buildername, RunConfigCheckSteps, TargetPresent
+from buildbot.process.metrics import MetricCountEvent, MetricTimeEvent
 from buildbot.process.results import Results, SUCCESS, FAILURE, CANCELLED, WARNINGS, SKIPPED, EXCEPTION, RETRY
-from buildbot.process.remotecommand import RemoteCommand
 
 from twisted.python import log
 from twisted.internet import defer
@@ -18,7 +21,7 @@ from dateutil.tz import tzutc
 
 import os
 import json
-import random
+import time
 
 
 builders = []
@@ -46,59 +49,141 @@ def ensure_props_set(props):
         "publish_destination": props.getProperty("publish_destination", "")
     }
 
-@defer.inlineCallbacks
-def shell(command, worker, builder):
-    args = {
-        'command': command,
-        'workdir': worker.worker_basedir,
-        'logEnviron': False,
-        'want_stdout': True,
-        'want_stderr': False,
-    }
-
-    cmd = RemoteCommand('shell', args, collectStdout=True, stdioLogName="stdio")
-    cmd.worker = worker
-    yield cmd.run(None, worker.conn, builder.name)
-    return cmd
+# With config.clobber_mode "async" the build directory is only renamed into a
+# .trash directory next to it, on the same filesystem so this is instant. A
+# single reaper per worker (serialised by flock) then deletes everything in
+# the trash in the background at idle I/O priority. It moves what it deletes
+# into .trash/.reaping first so the resource probe doesn't count half deleted
+# directories, and gives up when a pass can't get rid of anything.
+async_clobber = """
+set -e
+d="%(prop:builddir)s"
+trash="$(dirname "$d")/.trash"
+mkdir -p "$trash"
+if [ -e "$d" ]; then
+    mv "$d" "$trash/$(basename "$d")-$(date +%%s)-$$"
+fi
+setsid flock -n "$trash/.reaper.lock" ionice -c3 nice -n19 sh -c '
+    cd "$0" || exit 1
+    last=
+    while :; do
+        set -- *
+        [ -e "$1" ] || break
+        [ "$*" != "$last" ] || break
+        last="$*"
+        mkdir -p .reaping && mv -- "$@" .reaping/
+        rm -rf .reaping
+    done' "$trash" > /dev/null 2>&1 < /dev/null &
+"""
+
+def clobber_step(**kwargs):
+    if config.clobber_mode == "async":
+        command = util.Interpolate(async_clobber)
+    else:
+        # NOTE: Assumes that yocto-autobuilder repo has been cloned to home
+        # directory of the user running buildbot.
+        clob = os.path.expanduser("~/yocto-autobuilder-helper/janitor/clobberdir")
+        command = [clob, util.Interpolate("%(prop:builddir)s/")]
+    return steps.ShellCommand(command=command, name="Clobber build dir", **kwargs)
+
+# The worker gets a bundle of the pinned revision of the master's helper
+# mirror and fetches it into a fresh repository, pointing origin back at the real repository so the
+# checkout still looks like a normal clone to the helper scripts.
+helper_from_bundle = """
+set -e
+rm -rf yocto-autobuilder-helper
+git init -q yocto-autobuilder-helper
+cd yocto-autobuilder-helper
+git fetch -q ../helper.bundle '+refs/*:refs/bundle/*'
+git checkout -q %(prop:helper_revision)s
+git remote add origin {0}
+rm -f ../helper.bundle
+"""
+
+def helper_checkout_steps(refresh=False):
+    """
+    Steps checking out yocto-autobuilder-helper into the build directory,
+    'refresh' brings the master's mirror up to date first
+    """
+    if not config.helper_mirror:
+        return [steps.Git(
+            repourl=config.repos["yocto-autobuilder-helper"][0],
+            branch=config.repos["yocto-autobuilder-helper"][1],
+            workdir=util.Interpolate("%(prop:builddir)s/yocto-autobuilder-helper"),
+            mode='incremental',
+            haltOnFailure=True,
+            name='Fetch yocto-autobuilder-helper')]
+
+    return [
+        PinHelperRevision(refresh=refresh, haltOnFailure=True),
+        steps.FileDownload(
+            mastersrc=get_helper_bundle,
+            workerdest=util.Interpolate("%(prop:builddir)s/helper.bundle"),
+            workdir=util.Interpolate("%(prop:builddir)s"),
+            haltOnFailure=True,
+            name='Download yocto-autobuilder-helper bundle'),
+        steps.ShellCommand(
+            command=util.Interpolate(helper_from_bundle.format(config.repos["yocto-autobuilder-helper"][0])),
+            workdir=util.Interpolate("%(prop:builddir)s"),
+            haltOnFailure=True,
+            name='Fetch yocto-autobuilder-helper'),
+    ]
 
 @defer.inlineCallbacks
 def canStartBuild(builder, wfb, request):
     log.msg("Checking available disk space...")
 
-    cmd = yield shell("df -BG | grep $(findmnt -T . | awk '{print $2}' | sed -n 2p) | awk '{print $4}' | sed 's/[^0-9]*//g'", wfb.worker, builder)
-    threshold = 100 # GB of space
-    if int(cmd.stdout) < threshold:
-        log.msg("Detected {0} GB of space available, less than threshold of {1} GB. Can't start build".format(cmd.stdout, threshold))
-        wfb.worker.quarantine_timeout = 10 * 60
-        wfb.worker.putInQuarantine()
+    # Admission decisions need recent figures, other builds may have
+    # started on the worker since an older snapshot was taken. The background
+    # probing keeps them younger than TTL, so this only waits for a probe if
+    # that fell behind.
+    resources = workerresources.resources
+    snapshot = yield resources.get(wfb.worker, builder, max_age=resources.TTL)
+    if snapshot is None:
+        log.msg("Couldn't determine resources of worker {0}. Can't start build".format(wfb.worker.workername))
         return False
 
-    log.msg("Detected {0} GB of space available, more than threshold of {1} GB. OK to build".format(cmd.stdout, threshold))
-    if wfb.worker.isPaused():
-        # It was low on space so delay more than one build starting for a while
-        wfb.worker.quarantine_timeout = 15 * 60
-        wfb.worker.putInQuarantine()
-    else:
-        wfb.worker.exitQuarantine()
+    # Space already promised to builds which started but may not have
+    # used it yet is not available to us
+    diskusage.reservations.startConsuming(builder.master)
+    workername = wfb.worker.workername
+    needed = diskusage.history.estimate(builder.name)
+
+    def space(snapshot):
+        free = snapshot['disk_free_gb']
+        reserved = diskusage.reservations.reserved(workername, free)
+        # Build directories waiting for the async clobber reaper will be gone
+        # by the time the space is needed
+        trash = diskusage.history.trashSize(snapshot.get('trash', []))
+        return free, reserved, trash, free + trash - reserved
+
+    free, reserved, trash, available = space(snapshot)
+    if needed <= available < 2 * needed and resources.age(workername) > resources.FRESH:
+        # A close call, make sure we're not admitting the build based on
+        # space which has been used up since the snapshot was taken
+        fresh = yield resources.refresh(wfb.worker, builder)
+        if fresh is not None:
+            snapshot = fresh
+            free, reserved, trash, available = space(snapshot)
+
+    if available < needed:
+        log.msg("Detected {0} GB of space available ({1} GB reserved, {2:.0f} GB in trash), less than the {3:.0f} GB {4} needs. Can't start build".format(free, reserved, trash, needed, builder.name))
+        if available < config.disk_default_estimate:
+            quarantine.controller.quarantine(wfb.worker, builder, available)
+        return False
+
+    log.msg("Detected {0} GB of space available ({1} GB reserved, {2:.0f} GB in trash), more than the {3:.0f} GB {4} needs. OK to build".format(free, reserved, trash, needed, builder.name))
+    diskusage.reservations.reserve(workername, request.id, needed, free)
+    diskusage.history.started(request.id, workername, builder.name, snapshot)
+    quarantine.controller.admitted(wfb.worker, builder, available - needed)
+    workerselection.tracker.record(workername, builder.name, getBranch(request))
     return True
 
 def create_builder_factory():
     f = util.BuildFactory()
 
-    # NOTE: Assumes that yocto-autobuilder repo has been cloned to home
-    # directory of the user running buildbot.
-    clob = os.path.expanduser("~/yocto-autobuilder-helper/janitor/clobberdir")
-    f.addStep(steps.ShellCommand(
-        command=[clob, util.Interpolate("%(prop:builddir)s/")],
-        haltOnFailure=True,
-        name="Clobber build dir"))
-    f.addStep(steps.Git(
-        repourl=config.repos["yocto-autobuilder-helper"][0],
-        branch=config.repos["yocto-autobuilder-helper"][1],
-        workdir=util.Interpolate("%(prop:builddir)s/yocto-autobuilder-helper"),
-        mode='incremental',
-        haltOnFailure=True,
-        name='Fetch yocto-autobuilder-helper'))
+    f.addStep(clobber_step(haltOnFailure=True))
+    f.addSteps(helper_checkout_steps())
     f.addStep(TargetPresent())
     f.addStep(steps.SetProperties(properties=ensure_props_set))
     f.addStep(WriteLayerInfo(name='Write main layerinfo.json', haltOnFailure=True))
@@ -127,44 +212,69 @@ def create_builder_factory():
     f.addStep(RunConfigCheckSteps(posttrigger=False))
 
     # If the build was successful, clean up the build directory
-    f.addStep(steps.ShellCommand(
-        command=[clob, util.Interpolate("%(prop:builddir)s/")],
+    f.addStep(clobber_step(
         doStepIf=lambda step: step.build.results == SUCCESS,
-        haltOnFailure=False,
-        name="Clobber build dir"))
+        haltOnFailure=False))
 
     return f
 
-def nextWorker(bldr, workers, buildrequest):
-    forced_worker = buildrequest.properties.getProperty("worker", "*")
-    possible_workers = list(workers)
-
-    # Old releases can only build on a subset of the workers, filter accordingly
-    branch = None
+def getBranch(buildrequest):
     if '' in buildrequest.sources:
         # Has to be a better way to do this
-        branch = buildrequest.sources[''].branch
-    if branch and branch in config.workers_prev_releases and "bringup" not in bldr.name:
-        possible_workers = []
-        for w in workers:
-            if w.worker.workername.startswith(config.workers_prev_releases[branch]):
-                possible_workers.append(w)
-        log.msg("nextWorker: Limiting %s to workers %s for %s" % (str(bldr), str(possible_workers), branch))
-
-    if forced_worker == "*":
-        return random.choice(possible_workers) if possible_workers else None
-    for w in possible_workers:
-        if w.worker.workername == forced_worker:
-            return w
-    return None  # worker not yet available
+        return buildrequest.sources[''].branch
+    return None
+
+def usableWorkers(bldr, buildrequest, available):
+    """
+    Names of the workers in 'available' (a set like object of worker names)
+    which can take 'buildrequest'
+    """
+    # Old releases can only build on a subset of the workers, eligible_workers
+    # (computed below once all the builders are known) accounts for that
+    branch = getBranch(buildrequest)
+    eligible = eligible_workers.get((bldr.name, branch))
+    if eligible is None:
+        eligible = eligible_workers.get((bldr.name, None))
+    if eligible is None:
+        eligible = available
+    usable = available & eligible
+    forced_worker = buildrequest.properties.getProperty("worker", "*")
+    if forced_worker != "*":
+        usable = usable & {forced_worker}
+    return usable
+
+def nextWorker(bldr, workers, buildrequest):
+    available = {w.worker.workername: w for w in workers}
+    usable = usableWorkers(bldr, buildrequest, available.keys())
+    branch = getBranch(buildrequest)
+    if branch in config.workers_prev_releases:
+        log.msg("nextWorker: Limiting %s to workers %s for %s" % (str(bldr), sorted(usable), branch))
+
+    possible_workers = [available[name] for name in usable]
+    policy = workerselection.policies.get(config.worker_selection, workerselection.policies['random'])
+    chosen = policy.select(bldr, possible_workers, branch)
+    if chosen is None:
+        return None  # worker not yet available
+    # The affinity is only recorded once canStartBuild admits the build
+    return chosen
 
 # nextWorker above can block a request if there is no worker available.
 # _getNextUnclaimedBuildRequest will always return the first request
-# which then will always fail to find worker, and this will block the queue
-# We therefore randomise the build requests queue with nextBuild to avoid
-# blocking
+# which then will always fail to find worker, and this will block the queue.
+# We therefore pick the oldest request which one of the currently available
+# workers can take, skipping over those none of them can.
 def nextBuild(bldr, requests):
-    return random.choice(requests) if requests else None
+    available = {w.worker.workername for w in bldr.workers if w.isAvailable()}
+    skipped = 0
+    chosen = None
+    for request in sorted(requests, key=lambda r: r.submittedAt):
+        if usableWorkers(bldr, request, available):
+            chosen = request
+            break
+        skipped += 1
+    if skipped:
+        MetricCountEvent.log('yoctoabb.nextbuild.skipped', skipped)
+    return chosen
 
 # regular builders
 f = create_builder_factory()
@@ -187,6 +297,21 @@ for builder in config.builder_to_workers:
 # Ensure plain reproducible builds start earlier too
 builder_bonuses["reproducible"] = builder_bonuses["reproducible-debian"]
 
+# Cache of the aging settings for each builder name, see getAging
+builder_aging = {}
+
+def getAging(buildername):
+    """
+    The config.builder_aging settings applying to 'buildername'
+    """
+    if buildername not in builder_aging:
+        prefixes = [p for p in config.builder_aging if p != "default" and buildername.startswith(p)]
+        if prefixes:
+            builder_aging[buildername] = config.builder_aging[max(prefixes, key=len)]
+        else:
+            builder_aging[buildername] = config.builder_aging.get("default")
+    return builder_aging[buildername]
+
 # Modified default algothirm from buildbot with a bonus mechanism (thanks tardyp!)
 @defer.inlineCallbacks
 def prioritizeBuilders(master, builders):
@@ -200,16 +325,51 @@ def prioritizeBuilders(master, builders):
     # have the time zone set.
     max_time = max_time.replace(tzinfo=tzutc())
 
+    # The oldest unclaimed request of each builder normally comes from the
+    # mq fed index, the database is only asked while that is being loaded
+    started = time.monotonic()
+    index = requestindex.getRequestIndex(master)
+
+    # In "critical-path" mode the children of a triggered buildset, whose
+    # requests all share the same submission time, are started longest
+    # expected build first since the parent waits for the slowest of them.
+    # The durations are recorded by the BuildHistory service.
+    criticalpath = config.builder_priority == "critical-path"
+    now = datetime.now(tzutc())
+
     @defer.inlineCallbacks
     def transform(bldr):
-        time = yield bldr.getOldestRequestTime()
+        branch = None
+        if index.ready:
+            builderid = yield bldr.getBuilderId()
+            time, buildsetid = index.oldest(builderid)
+            if criticalpath and buildsetid is not None:
+                branch = index.branch(buildsetid)
+        else:
+            index.queries += 1
+            time = yield bldr.getOldestRequestTime()
+        bonus = builder_bonuses.get(bldr.name, timedelta(0))
+        priority = timedelta(0)
+        overdue = False
+        aging = getAging(bldr.name)
+        if time is not None and aging:
+            # Requests age faster the longer they wait and jump the queue
+            # once they've waited max_wait
+            wait = (now - time).total_seconds()
+            overdue = wait >= aging['max_wait']
+            boost = aging['max_wait'] * min(1, max(0, wait) / aging['max_wait']) ** aging['curve']
+            time = time - timedelta(seconds=boost)
         if time is None:
             time = max_time
+        elif criticalpath:
+            # Leave the time alone so the children of a buildset stay
+            # together and order those by expected duration instead
+            expected = buildhistory.durations.estimate(bldr.name, branch) or 0
+            priority = -(bonus + timedelta(seconds=expected))
         else:
-            if bldr.name in builder_bonuses:
-                time = time - builder_bonuses[bldr.name]
+            time = time - bonus
 
-        defer.returnValue((time, bldr))
+        defer.returnValue((not overdue, time, priority, bldr))
 
     transformed = yield defer.gatherResults(
         [transform(bldr) for bldr in builders])
@@ -217,45 +377,42 @@ def prioritizeBuilders(master, builders):
     # sort the transformed list synchronously, comparing None to the end of
     # the list
     def transformedKey(a):
-        (date, builder) = a
-        return (date, builder.name)
+        (notoverdue, date, priority, builder) = a
+        return (notoverdue, date, priority, builder.name)
 
     transformed.sort(key=transformedKey)
 
     # and reverse the transform
-    rv = [xf[1] for xf in transformed]
+    rv = [xf[3] for xf in transformed]
+
+    MetricTimeEvent.log('yoctoabb.prioritizeBuilders', time.monotonic() - started)
+    MetricCountEvent.log('yoctoabb.prioritizeBuilders.queries', index.takeQueryCount())
     return rv
 
 def create_parent_builder_factory(buildername, waitname):
     factory = util.BuildFactory()
-    # NOTE: Assumes that yocto-autobuilder repo has been cloned to home
-    # directory of the user running buildbot.
-    clob = os.path.expanduser("~/yocto-autobuilder-helper/janitor/clobberdir")
-    factory.addStep(steps.ShellCommand(
-                    command=[clob, util.Interpolate("%(prop:builddir)s/")],
-                    haltOnFailure=True,
-                    name="Clobber build dir"))
+    factory.addStep(clobber_step(haltOnFailure=True))
     # check out the source
-    factory.addStep(steps.Git(
-        repourl=config.repos["yocto-autobuilder-helper"][0],
-        branch=config.repos["yocto-autobuilder-helper"][1],
-        workdir=util.Interpolate("%(prop:builddir)s/yocto-autobuilder-helper"),
-        mode='incremental',
-        haltOnFailure=True,
-        name='Fetch yocto-autobuilder-helper'))
+    factory.addSteps(helper_checkout_steps(refresh=True))
     factory.addStep(WriteLayerInfo(name='Write main layerinfo.json', haltOnFailure=True))
+    # Builds with identical, fully pinned, layerinfo share one snapshot of the
+    # repos which only the first of them has to prepare
+    factory.addStep(AcquireSharedRepos(haltOnFailure=True))
+    factory.addStep(steps.ShellCommand(
+        command=["rm", "-fr", util.Interpolate("%(prop:sharedrepolocation)s")],
+        doStepIf=lambda step: step.getProperty("sharedrepo_prepare"),
+        haltOnFailure=True,
+        name="Clean shared repo dir"))
     factory.addStep(steps.ShellCommand(
         command=[
             util.Interpolate("%(prop:builddir)s/yocto-autobuilder-helper/scripts/prepare-shared-repos"),
             util.Interpolate("%(prop:builddir)s/layerinfo.json"),
-            util.Interpolate("{}/%(prop:buildername)s-%(prop:buildnumber)s".format(config.sharedrepodir)),
+            util.Interpolate("%(prop:sharedrepolocation)s"),
             "-p", get_publish_dest],
+        doStepIf=lambda step: step.getProperty("sharedrepo_prepare"),
         haltOnFailure=True,
         name="Prepare shared repositories"))
-    factory.addStep(steps.SetProperty(
-        property="sharedrepolocation",
-        value=util.Interpolate("{}/%(prop:buildername)s-%(prop:buildnumber)s".format(config.sharedrepodir))
-    ))
+    factory.addStep(MarkSharedReposReady())
     if buildername == "a-full":
         factory.addStep(steps.SetProperty(property="build_type", value="full"))
     else:
@@ -268,7 +425,7 @@ def create_parent_builder_factory(buildername, waitname):
             util.Interpolate("%(prop:builddir)s/layerinfo.json"),
             util.Interpolate("%(prop:builddir)s/build"),
             util.Property("buildername"),
-            "-c", util.Interpolate("{}/%(prop:buildername)s-%(prop:buildnumber)s".format(config.sharedrepodir)),
+            "-c", util.Interpolate("%(prop:sharedrepolocation)s"),
             "--workername", util.Interpolate("%(prop:workername)s"),
             "-p", util.Property("is_release")],
         haltOnFailure=True,
@@ -291,7 +448,7 @@ def create_parent_builder_factory(buildername, waitname):
     # cascade yp_build_* since it makes the UI cleaner for skipped builds
     def get_props_set():
         set_props = {
-            "sharedrepolocation": util.Interpolate("{}/%(prop:buildername)s-%(prop:buildnumber)s".format(config.sharedrepodir)),
+            "sharedrepolocation": util.Property("sharedrepolocation"),
             "is_release": util.Property("is_release"),
             "build_type": util.Property("build_type"),
             "buildappsrcrev": "",
@@ -301,7 +458,8 @@ def create_parent_builder_factory(buildername, waitname):
             "milestone_number": util.Property("milestone_number"),
             "rc_number": util.Property("rc_number"),
             "yp_build_revision": util.Property("yp_build_revision"),
-            "yp_build_branch": util.Property("yp_build_branch")
+            "yp_build_branch": util.Property("yp_build_branch"),
+            "helper_revision": util.Property("helper_revision")
         }
 
         for repo in config.buildertorepos[buildername]:
@@ -314,10 +472,38 @@ def create_parent_builder_factory(buildername, waitname):
 
         return set_props
 
+    # When split, the parent doesn't wait for its children. The post-trigger
+    # steps below run as a build of <buildername>-posttrigger, started by the
+    # PostTrigger service once the triggered buildset completes.
+    if config.split_parent_builds:
+        factory.addStep(steps.SetProperty(property="yp_split_parent", value=True))
     factory.addStep(steps.Trigger(schedulerNames=[waitname],
-                                  waitForFinish=True,
+                                  waitForFinish=not config.split_parent_builds,
                                   set_properties=get_props_set()))
 
+    if not config.split_parent_builds:
+        add_posttrigger_steps(factory)
+    else:
+        # Nothing else releases the shared repos if the parent failed before
+        # triggering its children, the post-trigger build never runs
+        add_release_steps(factory, untriggered)
+
+    return factory
+
+def untriggered(step):
+    return not any(s.name == "trigger" and s.results in (SUCCESS, WARNINGS)
+                   for s in step.build.executedSteps)
+
+def add_release_steps(factory, condition=lambda step: True):
+    factory.addStep(ReleaseSharedRepos(doStepIf=condition))
+    factory.addStep(steps.ShellCommand(
+                    command=get_sharedrepo_remove,
+                    doStepIf=lambda step: condition(step) and step.getProperty("sharedrepo_remove"),
+                    alwaysRun=True,
+                    haltOnFailure=True,
+                    name="Remove shared repo dir"))
+
+def add_posttrigger_steps(factory):
     factory.addStep(RunConfigCheckSteps(posttrigger=True))
 
     factory.addStep(steps.ShellCommand(
@@ -333,33 +519,45 @@ def create_parent_builder_factory(buildername, waitname):
         name="Send QA Email"))
 
 
+    add_release_steps(factory)
+
+def create_posttrigger_builder_factory():
+    """
+    The post-trigger phase of a split a-quick/a-full build, run with the
+    parent build's properties once all its children have finished.
+    """
+    factory = util.BuildFactory()
+    factory.addStep(clobber_step(haltOnFailure=True))
+    factory.addSteps(helper_checkout_steps())
+    factory.addStep(WriteLayerInfo(name='Write main layerinfo.json', haltOnFailure=True))
     factory.addStep(steps.ShellCommand(
-                    command=["rm", "-fr", util.Interpolate("{}/%(prop:buildername)s-%(prop:buildnumber)s".format(config.sharedrepodir))],
-                    haltOnFailure=True,
-                    name="Remove shared repo dir"))
+        command=[
+            util.Interpolate("%(prop:builddir)s/yocto-autobuilder-helper/scripts/shared-repo-unpack"),
+            util.Interpolate("%(prop:builddir)s/layerinfo.json"),
+            util.Interpolate("%(prop:builddir)s/build"),
+            get_parent_buildername,
+            "-c", util.Interpolate("%(prop:sharedrepolocation)s"),
+            "--workername", util.Interpolate("%(prop:workername)s"),
+            "-p", util.Property("is_release")],
+        haltOnFailure=True,
+        name="Unpack shared repositories"))
+
+    add_posttrigger_steps(factory)
 
     return factory
 
 builders.append(util.BuilderConfig(name="a-quick", workernames=config.workers, factory=create_parent_builder_factory("a-quick", "wait-quick"), canStartBuild=canStartBuild, nextWorker=nextWorker, nextBuild=nextBuild, env=extra_env))
 builders.append(util.BuilderConfig(name="a-full", workernames=config.workers, factory=create_parent_builder_factory("a-full", "wait-full"), canStartBuild=canStartBuild,nextWorker=nextWorker, nextBuild=nextBuild, env=extra_env))
+if config.split_parent_builds:
+    f = create_posttrigger_builder_factory()
+    for parent in ["a-quick", "a-full"]:
+        builders.append(util.BuilderConfig(name=parent + "-posttrigger", workernames=config.workers, factory=f, canStartBuild=canStartBuild, nextWorker=nextWorker, nextBuild=nextBuild, env=extra_env))
 
 def create_doc_builder_factory():
     f = util.BuildFactory()
 
-    # NOTE: Assumes that yocto-autobuilder repo has been cloned to home
-    # directory of the user running buildbot.
-    clob = os.path.expanduser("~/yocto-autobuilder-helper/janitor/clobberdir")
-    f.addStep(steps.ShellCommand(
-        command=[clob, util.Interpolate("%(prop:builddir)s/")],
-        haltOnFailure=True,
-        name="Clobber build dir"))
-    f.addStep(steps.Git(
-        repourl=config.repos["yocto-autobuilder-helper"][0],
-        branch=config.repos["yocto-autobuilder-helper"][1],
-        workdir=util.Interpolate("%(prop:builddir)s/yocto-autobuilder-helper"),
-        mode='incremental',
-        haltOnFailure=True,
-        name='Fetch yocto-autobuilder-helper'))
+    f.addStep(clobber_step(haltOnFailure=True))
+    f.addSteps(helper_checkout_steps())
     f.addStep(steps.Git(
         repourl=config.repos["yocto-docs"][0],
         branch=config.repos["yocto-docs"][1],
@@ -386,3 +584,17 @@ def create_doc_builder_factory():
 # Only run one docs build at a time
 docs_lock = util.MasterLock("docs_lock")
 builders.append(util.BuilderConfig(name="docs", workernames=config.workers, factory=create_doc_builder_factory(), canStartBuild=canStartBuild, nextWorker=nextWorker, nextBuild=nextBuild, env=extra_env, locks=[docs_lock.access('exclusive')]))
+
+# Map (builder, branch) to the names of the workers which may build it, so
+# nextWorker doesn't need to match worker names against the
+# workers_prev_releases prefixes for every request. Branches without any
+# restriction use the (builder, None) entry. Rebuilt whenever this file is
+# reloaded on reconfig.
+eligible_workers = {}
+for b in builders:
+    names = frozenset(b.workernames)
+    eligible_workers[(b.name, None)] = names
+    if "bringup" in b.name:
+        continue
+    for branch, prefixes in config.workers_prev_releases.items():
+        eligible_workers[(b.name, branch)] = frozenset(n for n in names if n.startswith(prefixes))
@@ -127,6 +127,59 @@ builders = ["a-quick", "a-full", "docs"] + subbuilders
 # Publishing settings
 sharedrepodir = "/srv/autobuilder/repos"
 publish_dest = "/srv/autobuilder/autobuilder.yocto.io/pub"
+# Space (GB) the unused shared repo snapshots under sharedrepodir/snapshots
+# may take up before the least recently used ones are removed
+sharedrepo_snapshot_budget = 200
+
+# Disk space (GB) a build is assumed to need until enough builds of its builder
+# have been measured, workers with less than this free are quarantined
+disk_default_estimate = 100
+
+# How build directories are clobbered: "sync" deletes them with the helper's
+# clobberdir script, "async" renames them into a .trash directory in the
+# worker's basedir and deletes them in the background at idle I/O priority
+clobber_mode = "sync"
+
+# Fetch yocto-autobuilder-helper from a mirror kept on the master rather than
+# having every build clone it from the remote server. Parent builds refresh
+# the mirror and pin the revision their children use, the worker gets a git
+# bundle of it over its existing connection to the master.
+helper_mirror = False
+
+# How nextWorker chooses between the available workers: "affinity" prefers
+# workers which recently built the same builder or branch and are lightly
+# loaded with plenty of free space, "random" picks any of them
+worker_selection = "random"
+
+# How prioritizeBuilders orders builders with pending requests: "bonus" starts
+# the oldest requests first, with a bonus for builders which can only use a
+# few workers, "critical-path" does the same but starts the children of a
+# triggered build with the longest expected duration first
+builder_priority = "bonus"
+
+# Aging of queued requests in prioritizeBuilders so builders which can use
+# any worker aren't starved by the constrained ones. Once a builder's oldest
+# request has waited 'max_wait' seconds it goes ahead of all builders which
+# aren't overdue. Before that its request is treated as older than it is by
+# max_wait * (wait / max_wait) ** curve. The longest matching builder name
+# prefix applies, otherwise "default". Empty disables aging, e.g.
+# builder_aging = {
+#     "default": {"max_wait": 4 * 60 * 60, "curve": 2},
+#     # The parents only wait on their children so shouldn't wait themselves
+#     "a-": {"max_wait": 30 * 60, "curve": 1},
+# }
+builder_aging = {}
+
+# Don't keep a-quick/a-full builds (and so a worker) waiting for their
+# children. Instead the parent ends after triggering them and its post-trigger
+# steps run as a build of a-quick-posttrigger/a-full-posttrigger once the
+# children have finished. Needs the PostTrigger service from services.py.
+split_parent_builds = False
+
+# Serve the /api/v2/etas, /api/v2/queuewaits and /api/v2/quarantinedworkers
+# data API endpoints. Buildbot has no supported way to add endpoints, this
+# relies on its internals.
+data_api_endpoints = False
 
 # Web UI settings
 web_port = 8010
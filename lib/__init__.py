@@ -0,0 +1,9 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+'''
+Code shared by the builders, schedulers and reporters. Unlike builders.py,
+the modules here aren't reloaded on a reconfig (see master.cfg), so state
+which has to survive one is kept in module-level singletons here.
+'''
@@ -0,0 +1,126 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+'''
+How long builds and their steps take, per builder, branch and step name,
+kept as an exponentially weighted moving average along with the most recent
+samples for percentiles. The figures are held in memory and written through
+to a small SQLite database so they survive restarts of the buildbot master.
+
+The duration of a whole build is stored under the step name '' and figures
+over all branches under the branch ''.
+'''
+
+from twisted.internet import threads
+from twisted.python import log
+
+from yoctoabb.lib.utils import basedir, percentile
+
+from collections import deque
+import json
+import os
+import sqlite3
+import threading
+
+
+class DurationStats(object):
+    # Weight of the newest sample in the average
+    ALPHA = 0.3
+    SAMPLES = 30
+
+    def __init__(self, ewma=None, samples=()):
+        self.ewma = ewma
+        self.samples = deque(samples, self.SAMPLES)
+
+    def add(self, seconds):
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma += self.ALPHA * (seconds - self.ewma)
+        self.samples.append(seconds)
+
+    def percentile(self, pct):
+        if not self.samples:
+            return None
+        return percentile(self.samples, pct)
+
+    def asDict(self):
+        return {
+            'ewma': self.ewma,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'count': len(self.samples),
+        }
+
+
+class DurationHistory(object):
+
+    def __init__(self, path):
+        self.path = path
+        # (buildername, branch, stepname) -> DurationStats
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS durations ("
+                              " builder TEXT NOT NULL,"
+                              " branch TEXT NOT NULL,"
+                              " step TEXT NOT NULL,"
+                              " ewma REAL NOT NULL,"
+                              " samples TEXT NOT NULL,"
+                              " PRIMARY KEY (builder, branch, step))")
+            for builder, branch, step, ewma, samples in self.conn.execute(
+                    "SELECT builder, branch, step, ewma, samples FROM durations"):
+                self.stats[(builder, branch, step)] = DurationStats(ewma, json.loads(samples))
+
+    def _save(self, rows):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO durations (builder, branch, step, ewma, samples)"
+                                  " VALUES (?, ?, ?, ?, ?)", rows)
+
+    def record(self, buildername, branch, seconds, stepname=''):
+        """
+        Add a build (or step if 'stepname' is given) which took 'seconds'
+        """
+        rows = []
+        for key in set([(buildername, '', stepname), (buildername, branch or '', stepname)]):
+            if key not in self.stats:
+                self.stats[key] = DurationStats()
+            stats = self.stats[key]
+            stats.add(seconds)
+            rows.append(key + (stats.ewma, json.dumps(list(stats.samples))))
+        d = threads.deferToThread(self._save, rows)
+        d.addErrback(log.err, "Couldn't save durations to %s" % self.path)
+        return d
+
+    def get(self, buildername, branch=None, stepname=''):
+        """
+        The DurationStats for the branch if there are any, otherwise those
+        over all branches, None if nothing was recorded
+        """
+        if branch and (buildername, branch, stepname) in self.stats:
+            return self.stats[(buildername, branch, stepname)]
+        return self.stats.get((buildername, '', stepname))
+
+    def estimate(self, buildername, branch=None, stepname=''):
+        """
+        The expected duration in seconds of a build of 'buildername' on
+        'branch' (or of its step 'stepname'), None if none was seen yet
+        """
+        stats = self.get(buildername, branch, stepname)
+        if stats is None:
+            return None
+        return stats.ewma
+
+    def steps(self, buildername, branch=None):
+        """
+        Statistics of each step seen in builds of 'buildername'
+        """
+        steps = {}
+        for (builder, stepbranch, stepname) in self.stats:
+            if builder == buildername and stepname and stepname not in steps:
+                steps[stepname] = self.get(buildername, branch, stepname).asDict()
+        return steps
+
+durations = DurationHistory(os.path.join(basedir, "build_history.sqlite"))
@@ -0,0 +1,59 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from collections import OrderedDict
+import time
+
+
+class LRUCache(object):
+    """
+    A simple size bounded mapping which evicts the least recently used entry
+    once 'max_size' entries are stored. If 'ttl' is set entries also expire
+    that many seconds after they were stored. Lookups are counted in 'hits'
+    and 'misses' so the effect of the cache can be monitored.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            value, expires = self.entries[key]
+            if expires is None or expires > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        if key in self.entries:
+            return self.entries.pop(key)[0]
+        return default
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,223 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from twisted.internet import defer
+from twisted.python import log
+
+from yoctoabb import config
+from yoctoabb.lib.utils import basedir, percentile
+
+from collections import deque
+import json
+import os
+import re
+import time
+
+
+class DiskUsageHistory(object):
+    """
+    The peak disk space used by the last SAMPLES builds of each builder,
+    persisted to disk_usage.json.
+
+    Rather than walking the build directory, the peak is taken from the
+    worker resource snapshots probed while the build runs: the drop from the
+    space available (free plus trash) when the build was admitted to the
+    lowest seen before it finished. Other builds running on the worker at
+    the same time make that an overestimate.
+    """
+    SAMPLES = 20
+    # Don't trust the history until we've seen this many builds
+    MIN_SAMPLES = 3
+    PERCENTILE = 90
+    # Safety margin added on top of the percentile
+    MARGIN = 1.1
+    # Forget builds we never saw finish after this long
+    EXPIRY = 24 * 60 * 60
+
+    def __init__(self, path):
+        self.path = path
+        self.usage = {}
+        # buildrequestid -> [workername, builder, available at admission,
+        #                    lowest available since, samples, time]
+        self.running = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    for builder, samples in json.load(f).items():
+                        self.usage[builder] = deque(samples, self.SAMPLES)
+            except (OSError, ValueError) as e:
+                log.err(e, "Couldn't load disk usage history from %s" % path)
+
+    def record(self, builder, gb):
+        if builder not in self.usage:
+            self.usage[builder] = deque(maxlen=self.SAMPLES)
+        self.usage[builder].append(gb)
+        try:
+            with open(self.path, 'w') as out:
+                json.dump({b: list(s) for b, s in self.usage.items()}, out)
+        except OSError as e:
+            log.err(e, "Couldn't save disk usage history to %s" % self.path)
+
+    def available(self, snapshot):
+        return snapshot['disk_free'] / (1024 ** 3) + self.trashSize(snapshot.get('trash', []))
+
+    def started(self, brid, workername, builder, snapshot):
+        now = time.monotonic()
+        for old, entry in list(self.running.items()):
+            if now - entry[5] > self.EXPIRY:
+                del self.running[old]
+        available = self.available(snapshot)
+        self.running[brid] = [workername, builder, available, available, 0, now]
+
+    def sample(self, workername, snapshot):
+        available = None
+        for entry in self.running.values():
+            if entry[0] == workername:
+                if available is None:
+                    available = self.available(snapshot)
+                entry[3] = min(entry[3], available)
+                entry[4] += 1
+
+    def finished(self, brid):
+        entry = self.running.pop(brid, None)
+        # Builds over before the worker was probed again tell us nothing
+        if entry and entry[4]:
+            self.record(entry[1], max(0, entry[2] - entry[3]))
+
+    def trashSize(self, entries):
+        """
+        Roughly how much space (GB) the clobbered build directories in a
+        worker's trash take up, going by what their builders last used.
+        Entries are named <builder>-<time>-<pid> by the async clobber, the
+        ones already being deleted aren't listed.
+        """
+        total = 0
+        for entry in entries:
+            m = re.match(r"^(.+)-\d+-\d+$", entry)
+            if m and self.usage.get(m.group(1)):
+                total += self.usage[m.group(1)][-1]
+        return total
+
+    def estimate(self, builder):
+        """
+        The space (GB) a build of 'builder' is expected to need at its peak
+        """
+        samples = self.usage.get(builder)
+        if not samples or len(samples) < self.MIN_SAMPLES:
+            return config.disk_default_estimate
+        return percentile(samples, self.PERCENTILE) * self.MARGIN
+
+
+class DiskReservations(object):
+    """
+    Disk space promised to builds which were allowed to start on a worker
+    but haven't finished yet, keyed by build request.
+
+    A running build gradually uses up the space reserved for it, which then
+    shows up in the worker's free space as well. To avoid counting that space
+    twice, the space which disappeared from the worker since the baseline was
+    taken is attributed to the reservations, oldest first as those builds
+    have been running longest, and deducted from them. When a reservation
+    goes, the space attributed to it stays used (build directories are only
+    clobbered by the next build) so the baseline moves down by that much.
+    """
+    # Forget reservations of builds we never saw finish after this long
+    EXPIRY = 24 * 60 * 60
+    # Forget reservations of builds which didn't start after this long, the
+    # claim failed, the worker went away or the request was cancelled
+    START_TIMEOUT = 10 * 60
+
+    def __init__(self):
+        # workername -> {buildrequestid: (gb, time, started)}, in reservation
+        # order
+        self.reservations = {}
+        # workername -> free space (GB) when its first reservation was made
+        self.baseline = {}
+        # workername -> free space (GB) last seen
+        self.free = {}
+        self.consumers = {}
+
+    @defer.inlineCallbacks
+    def startConsuming(self, master):
+        if master in self.consumers:
+            return
+        self.consumers[master] = []
+        consumer = yield master.mq.startConsuming(
+            self.buildNew,
+            ('builds', None, 'new'))
+        self.consumers[master].append(consumer)
+        consumer = yield master.mq.startConsuming(
+            self.buildFinished,
+            ('builds', None, 'finished'))
+        self.consumers[master].append(consumer)
+
+    def buildNew(self, key, build):
+        brid = build['buildrequestid']
+        for reservations in self.reservations.values():
+            if brid in reservations:
+                gb, when, started = reservations[brid]
+                reservations[brid] = (gb, when, True)
+
+    def buildFinished(self, key, build):
+        self.release(build['buildrequestid'])
+        history.finished(build['buildrequestid'])
+
+    def consumed(self, workername):
+        """
+        The space used up on 'workername' attributed to each of its
+        reservations
+        """
+        remaining = max(0, self.baseline[workername] - self.free[workername])
+        shares = {}
+        for brid, (gb, when, started) in self.reservations[workername].items():
+            shares[brid] = min(gb, remaining)
+            remaining -= shares[brid]
+        return shares
+
+    def drop(self, workername, brid):
+        self.baseline[workername] -= self.consumed(workername)[brid]
+        del self.reservations[workername][brid]
+        if not self.reservations[workername]:
+            del self.reservations[workername]
+            self.baseline.pop(workername, None)
+
+    def expire(self, workername):
+        now = time.monotonic()
+        for brid, (gb, when, started) in list(self.reservations.get(workername, {}).items()):
+            if now - when > self.EXPIRY or (not started and now - when > self.START_TIMEOUT):
+                log.msg("Expired disk reservation of request %s on %s" % (brid, workername))
+                self.drop(workername, brid)
+                if not started:
+                    history.running.pop(brid, None)
+
+    def reserved(self, workername, free):
+        """
+        Space (GB) still reserved on 'workername' given its current 'free'
+        space
+        """
+        self.free[workername] = free
+        self.expire(workername)
+        if not self.reservations.get(workername):
+            return 0
+        shares = self.consumed(workername)
+        return sum(gb - shares[brid] for brid, (gb, when, started) in self.reservations[workername].items())
+
+    def reserve(self, workername, brid, gb, free):
+        # A request which didn't start where it was admitted before may be
+        # tried on another worker
+        self.release(brid)
+        self.free[workername] = free
+        if not self.reservations.get(workername):
+            self.baseline[workername] = free
+        self.reservations.setdefault(workername, {})[brid] = (gb, time.monotonic(), False)
+
+    def release(self, brid):
+        for workername in list(self.reservations):
+            if brid in self.reservations[workername]:
+                self.drop(workername, brid)
+                log.msg("Released disk reservation of request %s on %s" % (brid, workername))
+            self.expire(workername)
+
+history = DiskUsageHistory(os.path.join(basedir, "disk_usage.json"))
+reservations = DiskReservations()
@@ -0,0 +1,118 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+'''
+A bare mirror of yocto-autobuilder-helper kept on the master, from which git
+bundles of pinned revisions are made for the workers so they don't all have
+to clone it from the remote server.
+'''
+
+from twisted.internet import defer, utils
+from twisted.python import log
+
+from yoctoabb import config
+from yoctoabb.lib.utils import basedir
+
+import os
+import time
+
+
+class HelperMirror(object):
+    # Don't refresh more often than this unless asked to
+    MIN_REFRESH = 5 * 60
+    # Bundles of this many revisions are kept
+    KEEP = 10
+
+    def __init__(self, path):
+        self.path = path
+        self.bundledir = path + "-bundles"
+        self.lock = defer.DeferredLock()
+        self.refreshed = 0
+
+    @defer.inlineCallbacks
+    def git(self, *args, **kwargs):
+        out, err, code = yield utils.getProcessOutputAndValue(
+            "git", args, env=os.environ, path=kwargs.get("path", self.path))
+        if code != 0:
+            raise RuntimeError("git %s failed: %s" % (" ".join(args), err.decode("utf-8", "replace").strip()))
+        return out.decode("utf-8").strip()
+
+    @defer.inlineCallbacks
+    def _refresh(self):
+        url = config.repos["yocto-autobuilder-helper"][0]
+        if not os.path.exists(self.path):
+            yield self.git("clone", "--mirror", "--quiet", url, self.path, path=basedir)
+        else:
+            yield self.git("remote", "set-url", "origin", url)
+            yield self.git("remote", "update", "--prune")
+        self.refreshed = time.monotonic()
+
+    @defer.inlineCallbacks
+    def pin(self, force=False):
+        """
+        Bring the mirror up to date (if 'force' is set or it's been a while)
+        and return the revision of the configured helper branch, making sure
+        there's a bundle of it
+        """
+        yield self.lock.acquire()
+        try:
+            if force or not os.path.exists(self.path) or time.monotonic() - self.refreshed > self.MIN_REFRESH:
+                try:
+                    yield self._refresh()
+                except Exception as e:
+                    # An out of date mirror is better than no build at all
+                    if not os.path.exists(self.path):
+                        raise
+                    log.err(e, "HelperMirror: Couldn't refresh %s, using it as is" % self.path)
+            branch = config.repos["yocto-autobuilder-helper"][1]
+            revision = yield self.git("rev-parse", "--verify", "%s^{commit}" % branch)
+            yield self._bundle(revision)
+        finally:
+            self.lock.release()
+        return revision
+
+    @defer.inlineCallbacks
+    def ensureBundle(self, revision):
+        """
+        Make sure there is a bundle containing the already pinned 'revision'
+        """
+        if os.path.exists(self.bundlePath(revision)):
+            return
+        yield self.lock.acquire()
+        try:
+            try:
+                yield self.git("cat-file", "-e", "%s^{commit}" % revision)
+            except RuntimeError:
+                # Pinned before the mirror was last refreshed by someone else
+                yield self._refresh()
+            yield self._bundle(revision)
+        finally:
+            self.lock.release()
+
+    def bundlePath(self, revision):
+        return os.path.join(self.bundledir, revision + ".bundle")
+
+    @defer.inlineCallbacks
+    def _bundle(self, revision):
+        bundle = self.bundlePath(revision)
+        if os.path.exists(bundle):
+            os.utime(bundle)
+            return
+        os.makedirs(self.bundledir, exist_ok=True)
+        # A bundle can only be made of refs, the branch may have moved on
+        # since 'revision' was pinned
+        ref = "refs/pinned/" + revision
+        yield self.git("update-ref", ref, revision)
+        try:
+            yield self.git("bundle", "create", bundle + ".tmp", ref)
+        finally:
+            yield self.git("update-ref", "-d", ref)
+        os.rename(bundle + ".tmp", bundle)
+
+        bundles = sorted((os.path.getmtime(os.path.join(self.bundledir, b)), b)
+                         for b in os.listdir(self.bundledir) if b.endswith(".bundle"))
+        for mtime, old in bundles[:-self.KEEP]:
+            os.unlink(os.path.join(self.bundledir, old))
+
+mirror = HelperMirror(os.path.join(basedir, "yocto-autobuilder-helper.git"))
@@ -0,0 +1,195 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.process.metrics import MetricCountEvent
+from twisted.internet import defer, task
+from twisted.python import log
+
+from yoctoabb import config
+from yoctoabb.lib import diskusage, workerresources
+
+from collections import deque
+import time
+
+
+class QuarantinedWorker(object):
+    def __init__(self, worker, builder):
+        self.worker = worker
+        self.builder = builder
+        # Number of times in a row the worker was found to be short of space
+        self.strikes = 0
+        self.since = time.monotonic()
+        self.next_probe = 0
+        self.probing = False
+        # (time, available GB) from the most recent probes
+        self.samples = deque(maxlen=QuarantineController.SAMPLES)
+
+    def trend(self):
+        """
+        Change in available space in GB per second over the recent probes,
+        None if there aren't enough of them to tell
+        """
+        if len(self.samples) < 2:
+            return None
+        (t0, gb0), (t1, gb1) = self.samples[0], self.samples[-1]
+        if t1 <= t0:
+            return None
+        return (gb1 - gb0) / (t1 - t0)
+
+
+class QuarantineController(object):
+    """
+    Keeps workers which are short of disk space out of use until a cheap
+    background probe sees enough space available again, rather than for a
+    fixed time. Workers which stay full are probed (and kept in quarantine)
+    for exponentially longer each time, up to MAX_TIMEOUT. Where the free
+    space is growing the next probe is brought forward to when the threshold
+    is expected to be cleared.
+    """
+    MIN_TIMEOUT = 60
+    MAX_TIMEOUT = 60 * 60
+    # How often to check whether any quarantined worker is due a probe
+    TICK = 15
+    SAMPLES = 10
+
+    def __init__(self):
+        # workername -> QuarantinedWorker
+        self.workers = {}
+        # Workers let out of quarantine which haven't been given a build yet
+        self.recovered = set()
+        self.loop = None
+
+    def timeout(self, state):
+        return min(self.MIN_TIMEOUT * 2 ** max(0, state.strikes - 1), self.MAX_TIMEOUT)
+
+    def schedule(self, state, available):
+        now = time.monotonic()
+        state.samples.append((now, available))
+        delay = self.timeout(state)
+        trend = state.trend()
+        if trend and trend > 0:
+            eta = (config.disk_default_estimate - available) / trend
+            delay = max(self.MIN_TIMEOUT, min(delay, eta))
+        state.next_probe = now + delay
+        # Buildbot's own timer only acts as a backstop should the probes fail
+        state.worker.quarantine_timeout = self.MAX_TIMEOUT
+        state.worker.putInQuarantine()
+
+    def quarantine(self, worker, builder, available):
+        """
+        Called when 'worker' was found to have only 'available' GB of usable
+        space, less than the configured threshold
+        """
+        state = self.workers.get(worker.workername)
+        if state is None:
+            state = self.workers[worker.workername] = QuarantinedWorker(worker, builder)
+        state.worker = worker
+        state.builder = builder
+        state.strikes += 1
+        self.schedule(state, available)
+        log.msg("Quarantined worker {0} with {1} GB available, next probe in {2:.0f}s".format(
+                worker.workername, available, state.next_probe - time.monotonic()))
+        self.report()
+        self.start()
+
+    def admitted(self, worker, builder, available):
+        """
+        Called when 'worker' was given a build. If it only just left
+        quarantine (or is paused) it isn't allowed to start more until it
+        has been probed again, so the space is seen being used up before
+        more builds pile onto it.
+        """
+        name = worker.workername
+        if name not in self.recovered and not worker.isPaused():
+            self.release(worker)
+            return
+        self.recovered.discard(name)
+        state = self.workers[name] = QuarantinedWorker(worker, builder)
+        self.schedule(state, available)
+        self.report()
+        self.start()
+
+    def release(self, worker, recovered=False):
+        self.workers.pop(worker.workername, None)
+        if recovered:
+            self.recovered.add(worker.workername)
+        timer = getattr(worker, 'quarantine_timer', None)
+        if timer and timer.active():
+            timer.cancel()
+        worker.exitQuarantine()
+        self.report()
+
+    def start(self):
+        if self.loop is None or not self.loop.running:
+            self.loop = task.LoopingCall(self.tick)
+            self.loop.start(self.TICK, now=False).addErrback(
+                log.err, "Quarantine probe loop failed")
+
+    def tick(self):
+        now = time.monotonic()
+        for name, state in list(self.workers.items()):
+            if state.next_probe > now or state.probing:
+                continue
+            if state.worker.conn is None:
+                # Worker went away, it starts over when it reconnects
+                log.msg("Worker {0} disconnected while quarantined".format(name))
+                self.workers.pop(name, None)
+                continue
+            # The probes run side by side, a slow worker doesn't hold up
+            # the others (and the probes time out, see WorkerResources)
+            state.probing = True
+            d = self.probe(state)
+            d.addErrback(log.err, "Couldn't probe quarantined worker %s" % name)
+            d.addBoth(lambda _, state=state: setattr(state, 'probing', False))
+        if not self.workers:
+            self.loop.stop()
+        self.report()
+
+    @defer.inlineCallbacks
+    def probe(self, state):
+        name = state.worker.workername
+        state.next_probe = time.monotonic() + self.timeout(state)
+        snapshot = yield workerresources.resources.refresh(state.worker, state.builder)
+        if self.workers.get(name) is not state:
+            # Released or quarantined afresh while we were probing
+            return
+        if snapshot is None:
+            return
+        free = snapshot['disk_free_gb']
+        trash = diskusage.history.trashSize(snapshot.get('trash', []))
+        available = free + trash - diskusage.reservations.reserved(name, free)
+        if available >= config.disk_default_estimate:
+            log.msg("Worker {0} has {1} GB available again after {2:.0f}s, leaving quarantine".format(
+                    name, available, time.monotonic() - state.since))
+            self.release(state.worker, recovered=state.strikes > 0)
+            return
+        state.strikes += 1
+        self.schedule(state, available)
+        log.msg("Worker {0} still has only {1} GB available, next probe in {2:.0f}s".format(
+                name, available, state.next_probe - time.monotonic()))
+
+    def report(self):
+        MetricCountEvent.log('yoctoabb.quarantined_workers', len(self.workers), absolute=True)
+
+    def getState(self):
+        """
+        The current quarantine state of each worker, for monitoring (see
+        /api/v2/quarantinedworkers in reporters/dataapi.py)
+        """
+        now = time.monotonic()
+        state = []
+        for name, worker in self.workers.items():
+            trend = worker.trend()
+            state.append({
+                'workername': name,
+                'strikes': worker.strikes,
+                'quarantined_for': int(now - worker.since),
+                'next_probe_in': int(max(0, worker.next_probe - now)),
+                'probing': worker.probing,
+                'available_gb': int(worker.samples[-1][1]) if worker.samples else None,
+                'trend_gb_per_hour': int(trend * 60 * 60) if trend is not None else None,
+            })
+        return state
+
+controller = QuarantineController()
@@ -0,0 +1,39 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from yoctoabb.lib.utils import percentile
+
+from collections import deque
+
+
+class QueueWaits(object):
+    """
+    How long the most recent build requests of each builder waited between
+    being submitted and being claimed, so the tail of the queue wait can be
+    watched per builder.
+    """
+    SAMPLES = 200
+
+    def __init__(self):
+        # builderid -> deque of seconds
+        self.waits = {}
+
+    def record(self, builderid, seconds):
+        if builderid not in self.waits:
+            self.waits[builderid] = deque(maxlen=self.SAMPLES)
+        self.waits[builderid].append(seconds)
+
+    def percentiles(self, builderid):
+        waits = self.waits.get(builderid)
+        if not waits:
+            return None
+        return {
+            'count': len(waits),
+            'p50': percentile(waits, 50),
+            'p90': percentile(waits, 90),
+            'p99': percentile(waits, 99),
+            'max': max(waits),
+        }
+
+waits = QueueWaits()
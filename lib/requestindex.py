@@ -0,0 +1,183 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.data import resultspec
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from yoctoabb.lib import queuewait
+from yoctoabb.lib.cache import LRUCache
+
+from datetime import datetime
+from dateutil.tz import tzutc
+import time
+import weakref
+
+
+def toDatetime(value):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=tzutc())
+    return value
+
+
+class RequestIndex(object):
+    """
+    The submission time of every unclaimed build request, per builder id,
+    kept current from the buildrequests mq events so the oldest request of
+    each builder can be found without querying the database.
+
+    The index is seeded with a single query once the events are being
+    consumed and again every RESYNC seconds in case an event was missed.
+    Until the first seed completes, and whenever the events aren't being
+    consumed, 'ready' is False and callers have to ask the database.
+    """
+    RESYNC = 10 * 60
+    BRANCHES = 256
+
+    def __init__(self, master):
+        self.master = master
+        # builderid -> {buildrequestid: (submitted_at, buildsetid)}
+        self.pending = {}
+        self.ready = False
+        self.consumer = None
+        self.seeding = None
+        self.lastSeed = 0
+        # Requests claimed, completed or added while a seed query was running
+        self.gone = set()
+        self.arrived = {}
+        self.queries = 0
+        # buildsetid -> branch
+        self.branches = LRUCache(self.BRANCHES)
+
+    @defer.inlineCallbacks
+    def startConsuming(self):
+        self.consumer = True
+        try:
+            self.consumer = yield self.master.mq.startConsuming(
+                self.requestChanged,
+                ('buildrequests', None, None))
+        except Exception as e:
+            log.err(e, "RequestIndex: Couldn't consume buildrequests events")
+            # Tried again the next time the index is used
+            self.consumer = None
+            self.ready = False
+            return
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stopConsuming)
+        self.seed()
+
+    def stopConsuming(self):
+        if self.consumer not in (None, True):
+            self.consumer.stopConsuming()
+        self.consumer = None
+        self.ready = False
+
+    def requestChanged(self, key, request):
+        brid = request['buildrequestid']
+        if request['claimed'] or request['complete']:
+            requests = self.pending.get(request['builderid'], {})
+            if request['claimed'] and request.get('claimed_at') and brid in requests:
+                wait = toDatetime(request['claimed_at']) - requests[brid][0]
+                queuewait.waits.record(request['builderid'], wait.total_seconds())
+            self.remove(brid)
+            if self.seeding:
+                self.gone.add(brid)
+                self.arrived.pop(brid, None)
+        else:
+            entry = (toDatetime(request['submitted_at']), request['buildsetid'])
+            self.pending.setdefault(request['builderid'], {})[brid] = entry
+            if self.seeding:
+                self.gone.discard(brid)
+                self.arrived[brid] = (request['builderid'], entry)
+
+    def remove(self, brid):
+        for builderid, requests in list(self.pending.items()):
+            if requests.pop(brid, None) is not None and not requests:
+                del self.pending[builderid]
+
+    @defer.inlineCallbacks
+    def seed(self):
+        self.seeding = True
+        self.gone = set()
+        self.arrived = {}
+        try:
+            self.queries += 1
+            unclaimed = yield self.master.data.get(
+                ('buildrequests',),
+                [resultspec.Filter('claimed', 'eq', [False]),
+                 resultspec.Filter('complete', 'eq', [False])])
+        except Exception as e:
+            log.err(e, "RequestIndex: Couldn't load the unclaimed build requests")
+            return
+        finally:
+            self.seeding = False
+        pending = {}
+        for request in unclaimed:
+            if request['buildrequestid'] not in self.gone:
+                entry = (toDatetime(request['submitted_at']), request['buildsetid'])
+                pending.setdefault(request['builderid'], {})[request['buildrequestid']] = entry
+        # Keep anything which arrived while the query was running
+        for brid, (builderid, entry) in self.arrived.items():
+            if brid not in self.gone:
+                pending.setdefault(builderid, {})[brid] = entry
+        self.pending = pending
+        self.gone = set()
+        self.arrived = {}
+        self.lastSeed = time.monotonic()
+        # Only trust the index while the events keep it up to date
+        self.ready = self.consumer not in (None, True)
+
+    def maybeSeed(self):
+        if self.consumer is None:
+            # Seeds once the events are being consumed
+            self.startConsuming()
+            return
+        if self.consumer is True or self.seeding or time.monotonic() - self.lastSeed < self.RESYNC:
+            return
+        self.seed()
+
+    def oldest(self, builderid):
+        """
+        The (submitted_at, buildsetid) of the oldest unclaimed request of
+        'builderid', or (None, None) if it has none
+        """
+        requests = self.pending.get(builderid)
+        if not requests:
+            return None, None
+        return min(requests.values(), key=lambda entry: entry[0])
+
+    def branch(self, buildsetid):
+        """
+        The branch built by 'buildsetid' if already known, otherwise None
+        and it is looked up in the background
+        """
+        if buildsetid in self.branches:
+            return self.branches.get(buildsetid)
+        self.branches.put(buildsetid, None)
+        d = self.master.data.get(('buildsets', buildsetid))
+
+        def found(buildset):
+            for ss in (buildset or {}).get('sourcestamps', []):
+                if ss.get('codebase', '') == '':
+                    self.branches.put(buildsetid, ss.get('branch'))
+
+        d.addCallback(found)
+        d.addErrback(log.err, "RequestIndex: Couldn't look up buildset %s" % buildsetid)
+        return None
+
+    def takeQueryCount(self):
+        queries, self.queries = self.queries, 0
+        return queries
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+def getRequestIndex(master):
+    """
+    Return the RequestIndex of 'master', starting to build it if needed
+    """
+    if master not in _indexes:
+        _indexes[master] = RequestIndex(master)
+    index = _indexes[master]
+    index.maybeSeed()
+    return index
@@ -0,0 +1,154 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+'''
+Bookkeeping for the shared repository snapshots under
+config.sharedrepodir/snapshots. A snapshot is prepared once for each distinct
+(fully resolved) layerinfo.json and shared by all the parent builds using it.
+The registry lives on the master, the directories themselves are created and
+removed by the workers.
+'''
+
+from twisted.python import log
+
+from yoctoabb import config
+from yoctoabb.lib.utils import basedir
+
+import json
+import os
+import time
+
+PREPARING = "preparing"
+READY = "ready"
+
+
+class SnapshotRegistry(object):
+    """
+    Snapshot state persisted to shared_repo_snapshots.json as
+    {hash: {'state', 'owner', 'since', 'dir', 'refs': {owner: time},
+    'last_used', 'size'}} where owners are "<buildername>-<buildnumber>" of
+    parent builds and size is in KB.
+
+    Each time a snapshot is (re)created it gets a directory of its own,
+    <hash>-<time>. Evicted directories are only removed later by a worker,
+    which mustn't hit a fresh snapshot of the same layerinfo.
+    """
+    # Forget references of builds which never released them after this long
+    REF_EXPIRY = 2 * 24 * 60 * 60
+    # Give up on snapshots still being prepared after this long, their owner
+    # went away without releasing them (e.g. a master restart mid-prepare)
+    PREPARE_EXPIRY = 6 * 60 * 60
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshots = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.snapshots = json.load(f)
+            except (OSError, ValueError) as e:
+                log.err(e, "Couldn't load shared repo snapshots from %s" % path)
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as out:
+                json.dump(self.snapshots, out, indent=1)
+        except OSError as e:
+            log.err(e, "Couldn't save shared repo snapshots to %s" % self.path)
+
+    def location(self, snaphash):
+        entry = self.snapshots.get(snaphash, {})
+        return os.path.join(config.sharedrepodir, "snapshots", entry.get('dir', snaphash))
+
+    def directories(self):
+        """
+        The names of the snapshot directories currently in use
+        """
+        return set(entry.get('dir', snaphash) for snaphash, entry in self.snapshots.items())
+
+    def expire(self, now):
+        """
+        Drop snapshots which have been preparing for too long. Returns their
+        directories.
+        """
+        evict = []
+        for snaphash, entry in list(self.snapshots.items()):
+            if entry['state'] == PREPARING and now - entry.get('since', now) > self.PREPARE_EXPIRY:
+                log.msg("Giving up on shared repo snapshot %s prepared by %s" % (snaphash, entry['owner']))
+                evict.append(self.location(snaphash))
+                del self.snapshots[snaphash]
+        return evict
+
+    def acquire(self, snaphash, owner):
+        """
+        Take a reference on the snapshot for 'snaphash'. Returns READY if it
+        can be used as is, PREPARING if 'owner' has to prepare it, or None
+        if another build is still preparing it.
+        """
+        now = time.time()
+        # Anything given up on here is removed by the janitor
+        self.expire(now)
+        entry = self.snapshots.get(snaphash)
+        if entry and entry['state'] == PREPARING and entry['owner'] != owner:
+            return None
+        if not entry:
+            entry = self.snapshots[snaphash] = {'state': PREPARING, 'owner': owner, 'since': now,
+                                                'dir': "%s-%d" % (snaphash, now), 'refs': {}, 'size': 0}
+        entry['refs'][owner] = now
+        entry['last_used'] = now
+        self.save()
+        return entry['state']
+
+    def ready(self, snaphash, size, location):
+        entry = self.snapshots.get(snaphash)
+        # Unless it was given up on and is being prepared again elsewhere
+        if entry and self.location(snaphash) == location:
+            entry['state'] = READY
+            entry['size'] = size
+            self.save()
+
+    def release(self, snaphash, owner):
+        """
+        Drop the reference of 'owner'. Returns the directories of snapshots
+        which should now be removed.
+        """
+        evict = []
+        entry = self.snapshots.get(snaphash)
+        if entry:
+            entry['refs'].pop(owner, None)
+            entry['last_used'] = time.time()
+            if entry['state'] == PREPARING and entry['owner'] == owner:
+                # Preparing it failed, start over next time
+                evict.append(self.location(snaphash))
+                del self.snapshots[snaphash]
+        evict.extend(self.collect())
+        self.save()
+        return evict
+
+    def collect(self):
+        """
+        Evict the least recently used unreferenced snapshots until the ready
+        ones fit within config.sharedrepo_snapshot_budget (GB)
+        """
+        now = time.time()
+        for entry in self.snapshots.values():
+            for owner, when in list(entry['refs'].items()):
+                if now - when > self.REF_EXPIRY:
+                    log.msg("Dropping stale reference of %s on a shared repo snapshot" % owner)
+                    del entry['refs'][owner]
+        evict = self.expire(now)
+
+        budget = config.sharedrepo_snapshot_budget * 1024 * 1024
+        total = sum(e['size'] for e in self.snapshots.values() if e['state'] == READY)
+        unused = [(e['last_used'], h) for h, e in self.snapshots.items()
+                  if e['state'] == READY and not e['refs']]
+        for last_used, snaphash in sorted(unused):
+            if total <= budget:
+                break
+            total -= self.snapshots[snaphash]['size']
+            evict.append(self.location(snaphash))
+            del self.snapshots[snaphash]
+        return evict
+
+registry = SnapshotRegistry(os.path.join(basedir, "shared_repo_snapshots.json"))
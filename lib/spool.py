@@ -0,0 +1,74 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+'''
+A small persistent FIFO of outbound events, stored in SQLite so that events
+queued for an external service survive that service being unavailable as
+well as restarts of the buildbot master.
+'''
+
+import json
+import sqlite3
+import threading
+import time
+
+from twisted.internet import threads
+
+
+class Spool(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS events ("
+                              " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                              " kind TEXT NOT NULL,"
+                              " data TEXT NOT NULL,"
+                              " created REAL NOT NULL)")
+
+    def _put(self, kind, data):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO events (kind, data, created) VALUES (?, ?, ?)",
+                              (kind, json.dumps(data), time.time()))
+
+    def _peek(self, limit):
+        with self.lock:
+            rows = self.conn.execute("SELECT id, kind, data FROM events ORDER BY id LIMIT ?",
+                                     (limit,)).fetchall()
+        return [(eventid, kind, json.loads(data)) for eventid, kind, data in rows]
+
+    def _remove(self, eventids):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM events WHERE id = ?",
+                                  [(eventid,) for eventid in eventids])
+
+    def _count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def put(self, kind, data):
+        """
+        Append an event of type 'kind' to the spool, 'data' must be JSON
+        serialisable.
+        """
+        return threads.deferToThread(self._put, kind, data)
+
+    def peek(self, limit):
+        """
+        Return (a Deferred firing with) up to 'limit' of the oldest events as
+        (id, kind, data) tuples without removing them.
+        """
+        return threads.deferToThread(self._peek, limit)
+
+    def remove(self, eventids):
+        return threads.deferToThread(self._remove, eventids)
+
+    def count(self):
+        return threads.deferToThread(self._count)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,25 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+'''
+Small helpers shared by the other modules in lib/
+'''
+
+import os
+
+# The buildbot master's working directory, where the state files kept by
+# the modules in lib/ go, next to the swatbot spool.
+# NOTE: we make a strong assumption here that this checkout is an immediate
+# child of the buildbot master's working directory, yocto-controller/yoctoabb
+# in README-Guide.md.
+basedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a non-empty list of numbers
+    """
+    values = sorted(values)
+    rank = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
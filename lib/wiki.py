@@ -12,48 +12,180 @@ __credits__ = ["Joshua Lock"]
 
 import codecs
 import hashlib
+import random
+import re
 import time
 import requests
+from twisted.internet import defer, reactor, task, threads
 from twisted.python import log
 
 
+class EditConflict(Exception):
+    """
+    The page was changed by someone else since the revision an edit was
+    based on and MediaWiki couldn't merge the changes
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Track consecutive failures talking to a remote service. After 'threshold'
+    failures in a row the circuit opens and calls are refused for
+    'reset_timeout' seconds, after which calls are let through again until
+    one fails or succeeds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=300):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+
+    def allow(self):
+        if self.opened is None:
+            return True
+        return time.monotonic() - self.opened >= self.reset_timeout
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures = self.failures + 1
+        if self.failures >= self.threshold:
+            if self.opened is None:
+                log.err("Wiki requests failing, pausing requests for %s seconds" % self.reset_timeout)
+            self.opened = time.monotonic()
+
+
+class BuildLogEntry(object):
+    def __init__(self, title, seq):
+        self.title = title
+        self.seq = seq
+
+
+class BuildLogPage(object):
+    """
+    An index of the entries of a BuildLog page, keyed by the parent build URL
+    and identifier in their titles:
+    ==[url builder buildid - buildbranch commit_hash on identifier]==
+
+    New entries are always added at the top of the page, directly after the
+    blurb (section 0). Entries are numbered in the order they were added so
+    the section index of an entry follows from its number without having to
+    renumber the whole index each time an entry is added.
+    """
+    title_re = re.compile(r'^==\[(.+)\]==', re.MULTILINE)
+
+    def __init__(self, blurb, entries, footer):
+        self.blurb = blurb
+        self.footer = footer
+        self.count = 0
+        self.next_seq = 0
+        self.by_url = {}
+        self.by_key = {}
+
+        titles = [m.group(1) for m in self.title_re.finditer(entries)]
+        for title in reversed(titles):
+            self.add(title)
+
+    @staticmethod
+    def parse_title(title):
+        title_components = title.split(None, 8)
+        identifier = None
+        if len(title_components) > 7 and title_components[6] == 'on':
+            identifier = title_components[7]
+        return title_components[0], identifier
+
+    def add(self, title):
+        """
+        Record a new entry 'title' added at the top of the page
+        """
+        entry = BuildLogEntry(title, self.next_seq)
+        self.next_seq = self.next_seq + 1
+        self.count = self.count + 1
+
+        # For lookups without an identifier the topmost entry wins
+        url, identifier = self.parse_title(title)
+        self.by_url[url] = entry
+        self.by_key[(url, identifier)] = entry
+        return entry
+
+    def find(self, url, identifier=None):
+        if identifier:
+            return self.by_key.get((url, identifier))
+        return self.by_url.get(url)
+
+    def section(self, entry):
+        """
+        The section index of 'entry', the newest entry is section 1
+        """
+        return self.next_seq - entry.seq
+
+
 class YPWiki(object):
     MAX_TRIES = 5
     TIMEOUT = 60
+    # Delays (seconds) between retries of failed requests
+    MIN_BACKOFF = 5
+    MAX_BACKOFF = 120
+    # Edit API error codes which mean our login session or edit token is no
+    # longer valid
+    LOGIN_ERRORS = ('assertuserfailed', 'assertnameduserfailed', 'badtoken',
+                    'notloggedin')
 
     def __init__(self, wiki_uri, wiki_un, wiki_pass):
         self.wiki_uri = wiki_uri
         self.wiki_un = wiki_un
         self.wiki_pass = wiki_pass
-
-    @staticmethod
-    def retry_request(requesturl, **kwargs):
+        # A single session keeps the connection to the wiki alive between
+        # requests and holds the login cookies
+        self.session = requests.Session()
+        self.cookies = None
+        self.edit_token = None
+        self.breaker = CircuitBreaker()
+
+    def _request(self, method, url, **kwargs):
+        kwargs['timeout'] = self.TIMEOUT
+        return self.session.request(method, url, **kwargs)
+
+    @defer.inlineCallbacks
+    def request(self, method, url, tries=1, **kwargs):
         """
-        Rather than failing when a request to a 'requesturl' throws an
-        exception retry again a minute later. Perform this retry no more than
-        5 times.
+        Perform a request in a thread pool thread, making up to 'tries'
+        attempts. Between attempts the thread is released and the retry is
+        scheduled with a timer using jittered exponential backoff. Returns
+        None when all attempts failed or the wiki is known to be down.
 
-        @type   requesturl:  string
+        @type   method:  string
+        @type   url:     string
         """
-        kwargs['timeout'] = YPWiki.TIMEOUT
-
-        def try_request():
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                log.msg("Wiki is unavailable, not sending request")
+                return None
             try:
-                req = requests.get(requesturl, **kwargs)
+                req = yield threads.deferToThread(self._request, method, url, **kwargs)
+                self.breaker.success()
                 return req
             except (requests.exceptions.RequestException,
                     requests.exceptions.Timeout):
+                self.breaker.failure()
+            attempt = attempt + 1
+            if attempt >= tries:
                 return None
+            delay = min(self.MAX_BACKOFF, self.MIN_BACKOFF * 2 ** (attempt - 1))
+            yield task.deferLater(reactor, random.uniform(delay / 2, delay), lambda: None)
 
-        tries = 0
-        req = None
-        while not req and tries < YPWiki.MAX_TRIES:
-            if tries > 0:
-                time.sleep(60)
-            req = try_request()
-            tries = tries + 1
+    def retry_request(self, requesturl, **kwargs):
+        """
+        Rather than failing when a request to a 'requesturl' throws an
+        exception retry again later. Perform this retry no more than 5 times.
 
-        return req
+        @type   requesturl:  string
+        """
+        return self.request('GET', requesturl, tries=self.MAX_TRIES, **kwargs)
 
     @staticmethod
     def parse_json(response):
@@ -81,10 +213,15 @@ class YPWiki(object):
 
         return response.json()
 
+    @defer.inlineCallbacks
     def login(self):
         """
-        Login to the wiki and return cookies for the logged in session
+        Login to the wiki and return cookies for the logged in session. The
+        login is cached until the wiki rejects it, see invalidate_login()
         """
+        if self.cookies is not None:
+            return self.cookies
+
         payload = {
             'action': 'login',
             'lgname': self.wiki_un,
@@ -93,26 +230,49 @@ class YPWiki(object):
             'format': 'json'
         }
 
-        try:
-            req1 = requests.post(self.wiki_uri, data=payload,
-                                 timeout=self.TIMEOUT)
-        except (requests.exceptions.RequestException,
-                requests.exceptions.Timeout):
+        req1 = yield self.request('POST', self.wiki_uri, data=payload)
+        if not req1:
             return None
 
         parsed = self.parse_json(req1)
         login_token = parsed['login']['token'].encode('utf-8')
 
         payload['lgtoken'] = login_token
-        try:
-            req2 = requests.post(self.wiki_uri, data=payload,
-                                 cookies=req1.cookies, timeout=self.TIMEOUT)
-        except (requests.exceptions.RequestException,
-                requests.exceptions.Timeout):
+        req2 = yield self.request('POST', self.wiki_uri, data=payload,
+                                  cookies=req1.cookies)
+        if not req2:
             return None
 
-        return req2.cookies.copy()
+        self.cookies = req2.cookies.copy()
+        return self.cookies
 
+    def invalidate_login(self):
+        """
+        Forget the cached login and edit token so the next login() performs
+        a fresh login
+        """
+        self.cookies = None
+        self.edit_token = None
+        self.session.cookies.clear()
+
+    @defer.inlineCallbacks
+    def get_edit_token(self, wiki_page, cookies):
+        if self.edit_token:
+            return self.edit_token
+
+        params = ("?format=json&action=query&prop=info|revisions"
+                  "&intoken=edit&rvprop=timestamp&titles=")
+        req = yield self.retry_request(self.wiki_uri+params+wiki_page,
+                                       cookies=cookies)
+        if not req:
+            return None
+
+        parsed = self.parse_json(req)
+        pageid = sorted(parsed['query']['pages'].keys())[-1]
+        self.edit_token = parsed['query']['pages'][pageid]['edittoken']
+        return self.edit_token
+
+    @defer.inlineCallbacks
     def get_content(self, wiki_page):
         """
         Get the current content of the 'wiki_page' -- to make the wiki page
@@ -121,24 +281,33 @@ class YPWiki(object):
         new entry after the log but before the other entries.
 
         This method fetches the current page content, splits out the blurb and
-        returns a pair:
+        returns:
         1) the blurb
         2) the current entries
+        3) the footer
+        4) the timestamps to edit the page with, see get_section()
 
         @type   wiki_page:  string
         """
 
-        pm = '?format=json&action=query&prop=revisions&rvprop=content&titles='
+        pm = ('?format=json&action=query&prop=revisions&rvprop=content|timestamp'
+              '&curtimestamp=1&titles=')
 
-        req = self.retry_request(self.wiki_uri+pm+wiki_page)
+        req = yield self.retry_request(self.wiki_uri+pm+wiki_page)
         if not req:
-            return None, None
+            return None, None, None, None
 
         parsed = self.parse_json(req)
         pageid = sorted(parsed['query']['pages'].keys())[-1]
         blurb, entries, footer = "\n", "", "\n==Archived Logs=="
+        timestamps = {}
         if 'revisions' in parsed['query']['pages'][pageid]:
-            content = parsed['query']['pages'][pageid]['revisions'][0]['*']
+            revision = parsed['query']['pages'][pageid]['revisions'][0]
+            content = revision['*']
+            timestamps = {
+                'basetimestamp': revision['timestamp'],
+                'starttimestamp': parsed.get('curtimestamp', revision['timestamp']),
+            }
             blurb, entries = content.split('==', 1)
             # ensure we keep only a single newline after the blurb
             blurb = blurb.strip() + "\n"
@@ -149,62 +318,135 @@ class YPWiki(object):
             except ValueError:
                 pass
 
-        return blurb, entries, footer
+        return blurb, entries, footer, timestamps
 
-    def post_entry(self, wiki_page, content, summary, cookies):
+    @defer.inlineCallbacks
+    def get_section(self, wiki_page, section):
         """
-        Post the new page contents 'content' to  the page title 'wiki_page'
-        with a 'summary' using the login credentials from 'cookies'
+        Get the wikitext of a single 'section' (by index) of 'wiki_page'.
+        Returns a pair of the text and the timestamps to pass to
+        edit_section() so an edit of the section based on this text is
+        detected as a conflict if the page changed in the meantime.
 
         @type   wiki_page:  string
-        @type   content:    string
-        @type   summary:    string
-        @type   cookies:    CookieJar
+        @type   section:    int
         """
 
-        params = ("?format=json&action=query&prop=info|revisions"
-                  "&intoken=edit&rvprop=timestamp&titles=")
-        req = self.retry_request(self.wiki_uri+params+wiki_page,
-                                 cookies=cookies)
+        pm = ('?format=json&action=query&prop=revisions&rvprop=content|timestamp'
+              '&curtimestamp=1&rvsection=%s&titles=' % section)
+
+        req = yield self.retry_request(self.wiki_uri+pm+wiki_page)
         if not req:
-            return False
+            return None, None
 
         parsed = self.parse_json(req)
         pageid = sorted(parsed['query']['pages'].keys())[-1]
-        edit_token = parsed['query']['pages'][pageid]['edittoken']
-        edit_cookie = cookies.copy()
-        edit_cookie.update(req.cookies)
+        page = parsed['query']['pages'][pageid]
+        if 'revisions' not in page:
+            return None, None
+        revision = page['revisions'][0]
+        timestamps = {
+            'basetimestamp': revision['timestamp'],
+            'starttimestamp': parsed.get('curtimestamp', revision['timestamp']),
+        }
+        return revision['*'], timestamps
 
-        content = content.encode('utf-8')
+    @defer.inlineCallbacks
+    def edit(self, wiki_page, summary, cookies, **kwargs):
+        """
+        Perform an edit of 'wiki_page' with a 'summary' using the login
+        credentials from 'cookies'. The keyword arguments are passed through
+        as parameters of the MediaWiki edit API, e.g. 'text', 'section',
+        'appendtext' or 'prependtext'. Raises EditConflict if the wiki
+        refuses the edit because of a conflicting one, see 'basetimestamp'.
 
-        content_hash = hashlib.md5(content).hexdigest()
+        @type   wiki_page:  string
+        @type   summary:    string
+        @type   cookies:    CookieJar
+        """
 
-        payload = {
-            'action': 'edit',
-            'assert': 'user',
-            'title': wiki_page,
-            'summary': summary,
-            'text': content,
-            'md5': content_hash,
-            'token': edit_token,
-            'utf8': '',
-            'format': 'json'
-        }
+        # The md5 covers 'text', or 'prependtext' and 'appendtext'
+        # concatenated when those are used instead
+        for key in ('text', 'prependtext', 'appendtext'):
+            if key in kwargs:
+                kwargs[key] = kwargs[key].encode('utf-8')
+        if 'text' in kwargs:
+            content = kwargs['text']
+        else:
+            content = kwargs.get('prependtext', b'') + kwargs.get('appendtext', b'')
 
-        try:
-            req = requests.post(self.wiki_uri, data=payload,
-                                cookies=edit_cookie, timeout=self.TIMEOUT)
-        except (requests.exceptions.RequestException,
-                requests.exceptions.Timeout):
-            return False
+        content_hash = hashlib.md5(content).hexdigest()
+
+        # Use the cached login and edit token, if the wiki rejects them login
+        # again and retry once
+        for attempt in range(2):
+            edit_token = yield self.get_edit_token(wiki_page, cookies)
+            if not edit_token:
+                return False
+
+            payload = {
+                'action': 'edit',
+                'assert': 'user',
+                'title': wiki_page,
+                'summary': summary,
+                'md5': content_hash,
+                'token': edit_token,
+                'utf8': '',
+                'format': 'json'
+            }
+            payload.update(kwargs)
+
+            req = yield self.request('POST', self.wiki_uri, data=payload,
+                                     cookies=cookies)
+            if not req:
+                return False
+
+            if not req.status_code == requests.codes.ok:
+                log.err("Unexpected status code %s received when trying to post"
+                        " an entry to the wiki." % req.status_code)
+                return False
 
-        if not req.status_code == requests.codes.ok:
-            log.err("Unexpected status code %s received when trying to post"
-                    " an entry to the wiki." % req.status_code)
-            return False
-        else:
             result = self.parse_json(req)
+            error = result.get('error', {}).get('code', '')
+            if error in self.LOGIN_ERRORS and attempt == 0:
+                log.msg("Wiki rejected our login (%s), logging in again" % error)
+                self.invalidate_login()
+                cookies = yield self.login()
+                if not cookies:
+                    return False
+                continue
+
+            if error == 'editconflict':
+                raise EditConflict(wiki_page)
+
             status = result.get('edit', {}).get('result', '')
             if status == 'Success':
                 return True
             return False
+        return False
+
+    def post_entry(self, wiki_page, content, summary, cookies, **kwargs):
+        """
+        Post the new page contents 'content' to  the page title 'wiki_page'
+        with a 'summary' using the login credentials from 'cookies', further
+        keyword arguments are as for edit()
+
+        @type   wiki_page:  string
+        @type   content:    string
+        @type   summary:    string
+        @type   cookies:    CookieJar
+        """
+        return self.edit(wiki_page, summary, cookies, text=content, **kwargs)
+
+    def edit_section(self, wiki_page, section, summary, cookies, **kwargs):
+        """
+        Edit only the section with index 'section' of 'wiki_page', the
+        keyword arguments are as for edit(). Pass the timestamps returned by
+        get_section() as 'basetimestamp' and 'starttimestamp' so an edit
+        racing with another one (e.g. another master adding an entry, which
+        shifts the section indices) can't replace the wrong section.
+
+        @type   wiki_page:  string
+        @type   section:    int
+        """
+        return self.edit(wiki_page, summary, cookies, section=section, **kwargs)
@@ -0,0 +1,186 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.process.remotecommand import RemoteCommand
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+from yoctoabb.lib import diskusage
+
+import json
+import time
+
+# Gather everything we want to know about a worker with a single process.
+# Run from the worker's basedir so the disk figures are for the filesystem
+# builds happen on.
+PROBE = """
+import json, os
+st = os.statvfs('.')
+mem = 0
+with open('/proc/meminfo') as f:
+    for line in f:
+        if line.startswith('MemAvailable:'):
+            mem = int(line.split()[1]) * 1024
+print(json.dumps({
+    'disk_free': st.f_bavail * st.f_frsize,
+    'inodes_free': st.f_favail,
+    'load': os.getloadavg(),
+    'mem_available': mem,
+    'cpus': os.cpu_count(),
+    'trash': [t for t in os.listdir('.trash') if not t.startswith('.')] if os.path.isdir('.trash') else [],
+}))
+"""
+
+@defer.inlineCallbacks
+def shell(command, worker, builder):
+    args = {
+        'command': command,
+        'workdir': worker.worker_basedir,
+        'logEnviron': False,
+        'want_stdout': True,
+        'want_stderr': False,
+    }
+
+    cmd = RemoteCommand('shell', args, collectStdout=True, stdioLogName="stdio")
+    cmd.worker = worker
+    yield cmd.run(None, worker.conn, builder.name)
+    return cmd
+
+
+class WorkerResources(object):
+    """
+    Per worker snapshots of free disk space, free inodes, load average and
+    available memory. Snapshots younger than TTL are used as is, older ones
+    are still used while a fresh one is fetched in the background. Only when
+    there's no snapshot younger than MAX_AGE (or the caller's 'max_age') does
+    the caller have to wait for the worker to be probed.
+
+    Once probed, connected workers are probed again every INTERVAL seconds
+    so their snapshots stay younger than TTL.
+    """
+    TTL = 60
+    INTERVAL = 30
+    MAX_AGE = 10 * 60
+    # Snapshots this young are as good as probing again
+    FRESH = 10
+    # Give up on probes which take longer than this
+    PROBE_TIMEOUT = 60
+
+    def __init__(self):
+        # workername -> (time, snapshot)
+        self.snapshots = {}
+        # workername -> list of Deferreds waiting on a running probe
+        self.probing = {}
+        # workername -> (worker, builder) to probe it with in the background
+        self.known = {}
+        self.loop = None
+
+    @defer.inlineCallbacks
+    def probe(self, worker, builder):
+        cmd = yield shell(["python3", "-c", PROBE], worker, builder)
+        snapshot = json.loads(cmd.stdout)
+        snapshot['disk_free_gb'] = snapshot['disk_free'] // (1024 ** 3)
+        return snapshot
+
+    def refresh(self, worker, builder):
+        """
+        Probe 'worker' unless a probe is already running, returns a Deferred
+        firing with the new snapshot or None if the probe failed
+        """
+        name = worker.workername
+        self.known[name] = (worker, builder)
+        self.startLoop()
+        d = defer.Deferred()
+        if name in self.probing:
+            self.probing[name].append(d)
+            return d
+        self.probing[name] = [d]
+
+        def done(snapshot):
+            self.snapshots[name] = (time.monotonic(), snapshot)
+            diskusage.history.sample(name, snapshot)
+            return snapshot
+
+        def failed(failure):
+            log.err(failure, "Couldn't probe resources of worker %s" % name)
+            return None
+
+        def notify(snapshot):
+            for waiting in self.probing.pop(name):
+                waiting.callback(snapshot)
+
+        probe = self.probe(worker, builder)
+        # A hung worker mustn't leave everyone waiting on its probe forever
+        timer = reactor.callLater(self.PROBE_TIMEOUT, probe.cancel)
+
+        def stopTimer(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        probe.addBoth(stopTimer)
+        probe.addCallbacks(done, failed)
+        probe.addCallback(notify)
+        return d
+
+    def startLoop(self):
+        if self.loop is not None:
+            return
+        self.loop = task.LoopingCall(self.refreshAll)
+        self.loop.start(self.INTERVAL, now=False).addErrback(
+            log.err, "WorkerResources: Background probing failed")
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stopLoop)
+
+    def stopLoop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def refreshAll(self):
+        for name, (worker, builder) in list(self.known.items()):
+            if worker.conn is None:
+                # Probed again once it's back and asked for a build
+                del self.known[name]
+                continue
+            age = self.age(name)
+            if age is None or age >= self.INTERVAL:
+                self.refresh(worker, builder)
+
+    @defer.inlineCallbacks
+    def get(self, worker, builder, max_age=None):
+        if max_age is None:
+            max_age = self.MAX_AGE
+        entry = self.snapshots.get(worker.workername)
+        if entry:
+            age = time.monotonic() - entry[0]
+            if age < min(self.TTL, max_age):
+                return entry[1]
+            if age < max_age:
+                self.refresh(worker, builder)
+                return entry[1]
+        snapshot = yield self.refresh(worker, builder)
+        return snapshot
+
+    def peek(self, workername):
+        """
+        The last snapshot of 'workername' no older than MAX_AGE, without
+        probing the worker
+        """
+        entry = self.snapshots.get(workername)
+        if entry and time.monotonic() - entry[0] < self.MAX_AGE:
+            return entry[1]
+        return None
+
+    def age(self, workername):
+        """
+        Seconds since 'workername' was last probed, None if it never was
+        """
+        entry = self.snapshots.get(workername)
+        if entry:
+            return time.monotonic() - entry[0]
+        return None
+
+    def invalidate(self, worker):
+        self.snapshots.pop(worker.workername, None)
+
+resources = WorkerResources()
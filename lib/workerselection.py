@@ -0,0 +1,101 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+'''
+Policies for choosing which of the available workers a build request goes
+to, selected with config.worker_selection.
+'''
+
+from yoctoabb.lib import workerresources
+
+from collections import deque
+import random
+import time
+
+
+class AffinityTracker(object):
+    """
+    Remembers which builders and branches were recently sent to each worker,
+    and so which workers are likely to have warm sstate, downloads and
+    checkouts for them.
+    """
+    # Builds remembered per worker
+    SIZE = 20
+    # Affinity fades out completely over this many seconds
+    WINDOW = 6 * 60 * 60
+
+    def __init__(self):
+        # workername -> deque of (time, buildername, branch)
+        self.recent = {}
+
+    def record(self, workername, buildername, branch):
+        if workername not in self.recent:
+            self.recent[workername] = deque(maxlen=self.SIZE)
+        self.recent[workername].append((time.monotonic(), buildername, branch))
+
+    def affinity(self, workername, buildername, branch):
+        """
+        Between 0 (nothing in common built lately) and 1 (the same builder
+        and branch was just built there)
+        """
+        now = time.monotonic()
+        best = 0
+        for when, bname, bbranch in self.recent.get(workername, ()):
+            fade = 1 - (now - when) / self.WINDOW
+            if fade <= 0:
+                continue
+            if bname == buildername and bbranch == branch:
+                match = 1.0
+            elif bname == buildername:
+                match = 0.6
+            elif branch and bbranch == branch:
+                match = 0.3
+            else:
+                continue
+            best = max(best, match * fade)
+        return best
+
+
+class RandomPolicy(object):
+    def select(self, bldr, workers, branch):
+        return random.choice(workers) if workers else None
+
+
+class AffinityPolicy(object):
+    """
+    Score each worker by its affinity for the builder and branch, its load
+    and its free disk space, using whatever resource snapshot is already
+    cached for it. Picks randomly between the workers scoring within TIE of
+    the best so that equally good workers share the work.
+    """
+    AFFINITY_WEIGHT = 3.0
+    LOAD_WEIGHT = 1.0
+    DISK_WEIGHT = 1.0
+    # Free space beyond this doesn't make a worker any more attractive
+    DISK_SCALE = 1000
+    TIE = 0.1
+
+    def score(self, wfb, bldr, branch):
+        name = wfb.worker.workername
+        score = self.AFFINITY_WEIGHT * tracker.affinity(name, bldr.name, branch)
+        snapshot = workerresources.resources.peek(name)
+        if snapshot:
+            cpus = snapshot.get('cpus') or 1
+            score -= self.LOAD_WEIGHT * min(snapshot['load'][0] / cpus, 2)
+            score += self.DISK_WEIGHT * min(snapshot['disk_free_gb'] / self.DISK_SCALE, 1)
+        return score
+
+    def select(self, bldr, workers, branch):
+        if not workers:
+            return None
+        scores = [(self.score(w, bldr, branch), w) for w in workers]
+        best = max(score for score, w in scores)
+        return random.choice([w for score, w in scores if score >= best - self.TIE])
+
+policies = {
+    'random': RandomPolicy(),
+    'affinity': AffinityPolicy(),
+}
+
+tracker = AffinityTracker()
@@ -0,0 +1,216 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.process.results import SUCCESS, WARNINGS
+from buildbot.util import service
+from twisted.internet import defer
+from twisted.python import log
+
+from yoctoabb.lib import queuewait
+from yoctoabb.lib.buildhistory import durations
+from yoctoabb.lib.requestindex import getRequestIndex
+
+from datetime import datetime, timedelta
+from dateutil.tz import tzutc
+import weakref
+
+# The BuildHistory service of each master, for the data API endpoints
+_services = weakref.WeakKeyDictionary()
+
+
+class RunningBuild(object):
+    def __init__(self, build, buildername, branch):
+        self.buildid = build['buildid']
+        self.buildrequestid = build['buildrequestid']
+        self.builderid = build['builderid']
+        self.started_at = build['started_at']
+        self.buildername = buildername
+        self.branch = branch
+
+
+class BuildHistory(service.BuildbotService):
+    """
+    Records how long builds and their steps take (see lib/buildhistory.py)
+    and predicts when running and queued builds will finish. Predictions
+    are served by the /api/v2/etas data API endpoint and the ETA of each
+    running build is set as its yp_eta property for the console view.
+    Queue wait percentiles per builder are served at /api/v2/queuewaits.
+    The endpoints are in dataapi.py.
+    """
+    name = "BuildHistory"
+    # buildid -> RunningBuild
+    running = None
+    # builderid -> buildername
+    buildernames = None
+
+    @defer.inlineCallbacks
+    def reconfigService(self, **kwargs):
+        yield service.BuildbotService.reconfigService(self)
+        # Builds in progress carry over a reconfig
+        if self.running is None:
+            self.running = {}
+            self.buildernames = {}
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+
+        _services[self.master] = self
+
+        startConsuming = self.master.mq.startConsuming
+        self._buildStartedConsumer = yield startConsuming(
+            self.buildStarted,
+            ('builds', None, 'new'))
+
+        self._buildCompleteConsumer = yield startConsuming(
+            self.buildFinished,
+            ('builds', None, 'finished'))
+
+        self._stepCompleteConsumer = yield startConsuming(
+            self.stepFinished,
+            ('steps', None, 'finished'))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self._buildStartedConsumer.stopConsuming()
+        self._buildCompleteConsumer.stopConsuming()
+        self._stepCompleteConsumer.stopConsuming()
+        if _services.get(self.master) is self:
+            del _services[self.master]
+        yield service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def getBuilderName(self, builderid):
+        if builderid not in self.buildernames:
+            builder = yield self.master.data.get(('builders', builderid))
+            self.buildernames[builderid] = builder['name']
+        return self.buildernames[builderid]
+
+    @defer.inlineCallbacks
+    def getRunningBuild(self, build):
+        if build['buildid'] in self.running:
+            return self.running[build['buildid']]
+        buildername = yield self.getBuilderName(build['builderid'])
+        branch = None
+        request = yield self.master.data.get(('buildrequests', build['buildrequestid']))
+        if request:
+            buildset = yield self.master.data.get(('buildsets', request['buildsetid']))
+            for ss in (buildset or {}).get('sourcestamps', []):
+                if ss.get('codebase', '') == '':
+                    branch = ss.get('branch')
+        running = RunningBuild(build, buildername, branch)
+        self.running[build['buildid']] = running
+        return running
+
+    @defer.inlineCallbacks
+    def buildStarted(self, key, build):
+        try:
+            running = yield self.getRunningBuild(build)
+        except Exception as e:
+            log.err(e, "BuildHistory: Couldn't look up build %s" % build['buildid'])
+            return
+        expected = durations.estimate(running.buildername, running.branch)
+        if expected is None or running.started_at is None:
+            return
+        eta = running.started_at + timedelta(seconds=expected)
+        yield self.master.data.updates.setBuildProperty(
+            build['buildid'], 'yp_eta', int(eta.timestamp()), self.name)
+
+    @defer.inlineCallbacks
+    def stepFinished(self, key, step):
+        if step['results'] not in (SUCCESS, WARNINGS) or not step.get('started_at') or not step.get('complete_at'):
+            return
+        try:
+            running = self.running.get(step['buildid'])
+            if running is None:
+                # The build started before this service did
+                build = yield self.master.data.get(('builds', step['buildid']))
+                running = yield self.getRunningBuild(build)
+        except Exception as e:
+            log.err(e, "BuildHistory: Couldn't look up build %s" % step['buildid'])
+            return
+        seconds = (step['complete_at'] - step['started_at']).total_seconds()
+        durations.record(running.buildername, running.branch, seconds, step['name'])
+
+    @defer.inlineCallbacks
+    def buildFinished(self, key, build):
+        try:
+            running = yield self.getRunningBuild(build)
+        except Exception as e:
+            log.err(e, "BuildHistory: Couldn't look up build %s" % build['buildid'])
+            return
+        finally:
+            self.running.pop(build['buildid'], None)
+        # Failed builds stop early and say little about how long a build takes
+        if build['results'] not in (SUCCESS, WARNINGS) or not build.get('started_at') or not build.get('complete_at'):
+            return
+        seconds = (build['complete_at'] - build['started_at']).total_seconds()
+        durations.record(running.buildername, running.branch, seconds)
+
+    def getEtas(self):
+        """
+        The predicted duration and finish time of each running build and
+        queued build request. Queued requests are assumed to start now.
+        """
+        now = datetime.now(tzutc())
+        etas = []
+        for running in self.running.values():
+            expected = durations.estimate(running.buildername, running.branch)
+            etas.append({
+                'buildrequestid': running.buildrequestid,
+                'buildid': running.buildid,
+                'builderid': running.builderid,
+                'buildername': running.buildername,
+                'branch': running.branch,
+                'expected_duration': int(expected) if expected is not None else None,
+                'started_at': running.started_at,
+                'eta': running.started_at + timedelta(seconds=expected) if expected is not None else None,
+                'steps': durations.steps(running.buildername, running.branch),
+            })
+
+        index = getRequestIndex(self.master)
+        for builderid, requests in index.pending.items():
+            buildername = self.buildernames.get(builderid)
+            if buildername is None:
+                # Learn the name for next time
+                self.getBuilderName(builderid).addErrback(log.err)
+                continue
+            for brid, (submitted, buildsetid) in requests.items():
+                branch = index.branch(buildsetid)
+                expected = durations.estimate(buildername, branch)
+                etas.append({
+                    'buildrequestid': brid,
+                    'buildid': None,
+                    'builderid': builderid,
+                    'buildername': buildername,
+                    'branch': branch,
+                    'expected_duration': int(expected) if expected is not None else None,
+                    'started_at': None,
+                    'eta': now + timedelta(seconds=expected) if expected is not None else None,
+                    'steps': durations.steps(buildername, branch),
+                })
+        return etas
+
+
+    def getQueueWaits(self):
+        """
+        Percentiles of the time recent requests of each builder spent
+        queued, in seconds
+        """
+        result = []
+        for builderid in queuewait.waits.waits:
+            stats = queuewait.waits.percentiles(builderid)
+            if stats is None:
+                continue
+            entry = {'builderid': builderid, 'buildername': self.buildernames.get(builderid)}
+            entry.update((k, int(v)) for k, v in stats.items())
+            result.append(entry)
+        return result
+
+
+def getBuildHistory(master):
+    """
+    The running BuildHistory service of 'master', if any
+    """
+    return _services.get(master)
@@ -0,0 +1,141 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.data import base, types
+from buildbot.util import service
+from twisted.internet import defer
+from twisted.python import log
+
+from yoctoabb.lib import quarantine
+from yoctoabb.reporters.buildhistory import getBuildHistory
+
+import sys
+import weakref
+
+_registered = weakref.WeakKeyDictionary()
+
+
+class EtasEndpoint(base.Endpoint):
+
+    isCollection = True
+    rootLinkName = 'etas'
+    pathPatterns = """
+        /etas
+    """
+
+    def get(self, resultSpec, kwargs):
+        history = getBuildHistory(self.master)
+        if history is None:
+            return defer.succeed([])
+        return defer.succeed(history.getEtas())
+
+
+class Eta(base.ResourceType):
+
+    name = "eta"
+    plural = "etas"
+    endpoints = [EtasEndpoint]
+    keyFields = ['buildrequestid']
+    eventPathPatterns = ""
+
+    class EntityType(types.Entity):
+        buildrequestid = types.Integer()
+        buildid = types.NoneOk(types.Integer())
+        builderid = types.Integer()
+        buildername = types.String()
+        branch = types.NoneOk(types.String())
+        expected_duration = types.NoneOk(types.Integer())
+        started_at = types.NoneOk(types.DateTime())
+        eta = types.NoneOk(types.DateTime())
+        steps = types.JsonObject()
+    entityType = EntityType(name)
+
+
+class QueueWaitsEndpoint(base.Endpoint):
+
+    isCollection = True
+    rootLinkName = 'queuewaits'
+    pathPatterns = """
+        /queuewaits
+    """
+
+    def get(self, resultSpec, kwargs):
+        history = getBuildHistory(self.master)
+        if history is None:
+            return defer.succeed([])
+        return defer.succeed(history.getQueueWaits())
+
+
+class QueueWait(base.ResourceType):
+
+    name = "queuewait"
+    plural = "queuewaits"
+    endpoints = [QueueWaitsEndpoint]
+    keyFields = ['builderid']
+    eventPathPatterns = ""
+
+    class EntityType(types.Entity):
+        builderid = types.Integer()
+        buildername = types.NoneOk(types.String())
+        count = types.Integer()
+        p50 = types.Integer()
+        p90 = types.Integer()
+        p99 = types.Integer()
+        max = types.Integer()
+    entityType = EntityType(name)
+
+
+class QuarantinedWorkersEndpoint(base.Endpoint):
+
+    isCollection = True
+    rootLinkName = 'quarantinedworkers'
+    pathPatterns = """
+        /quarantinedworkers
+    """
+
+    def get(self, resultSpec, kwargs):
+        return defer.succeed(quarantine.controller.getState())
+
+
+class QuarantinedWorker(base.ResourceType):
+
+    name = "quarantinedworker"
+    plural = "quarantinedworkers"
+    endpoints = [QuarantinedWorkersEndpoint]
+    keyFields = ['workername']
+    eventPathPatterns = ""
+
+    class EntityType(types.Entity):
+        workername = types.String()
+        strikes = types.Integer()
+        quarantined_for = types.Integer()
+        next_probe_in = types.Integer()
+        probing = types.Boolean()
+        available_gb = types.NoneOk(types.Integer())
+        trend_gb_per_hour = types.NoneOk(types.Integer())
+    entityType = EntityType(name)
+
+
+class DataApiEndpoints(service.BuildbotService):
+    """
+    Adds the resource types above to the data API, i.e. /api/v2/etas,
+    /api/v2/queuewaits and /api/v2/quarantinedworkers. Buildbot has no supported way for a configuration
+    to add data API endpoints so this scans this module the way buildbot
+    scans its own, which relies on buildbot internals and is why the
+    service is only enabled with config.data_api_endpoints. Should that
+    fail the master carries on without the endpoints.
+    """
+    name = "DataApiEndpoints"
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        # Endpoints can't be removed again, only add them once per master
+        if self.master in _registered:
+            return
+        try:
+            self.master.data._scanModule(sys.modules[__name__])
+            _registered[self.master] = True
+        except Exception as e:
+            log.err(e, "DataApiEndpoints: Couldn't add endpoints to the data API")
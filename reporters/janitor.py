@@ -0,0 +1,153 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.data import resultspec
+from buildbot.process.metrics import MetricCountEvent
+from buildbot.util import service
+from twisted.internet import defer, task, threads
+from twisted.python import log
+
+from yoctoabb import config
+from yoctoabb.lib import snapshots
+
+import os
+import re
+import shutil
+import time
+
+
+def treeSize(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def removeTree(path):
+    size = treeSize(path)
+    shutil.rmtree(path, ignore_errors=True)
+    return size
+
+
+class SharedRepoJanitor(service.BuildbotService):
+    """
+    Removes shared repo directories left behind in config.sharedrepodir by
+    parent builds which never reached their "Remove shared repo dir" step,
+    e.g. because they were cancelled or the master restarted. Every
+    'interval' seconds each <buildername>-<buildnumber> directory is checked
+    against the build it belongs to. It is removed once that build is
+    complete (or unknown), no buildset triggered by it is still running and
+    the directory hasn't changed for 'grace' seconds. Snapshot directories no
+    longer in the snapshot registry are removed in the same way.
+    """
+    name = "SharedRepoJanitor"
+    dirre = re.compile(r"^(.+)-(\d+)$")
+    # Total since the master started, kept on the class so a reconfig
+    # replacing the service doesn't reset it
+    reclaimed = 0
+
+    def checkConfig(self, interval=60 * 60, grace=6 * 60 * 60, **kwargs):
+        service.BuildbotService.checkConfig(self)
+
+    @defer.inlineCallbacks
+    def reconfigService(self, interval=60 * 60, grace=6 * 60 * 60, **kwargs):
+        yield service.BuildbotService.reconfigService(self)
+        self.interval = interval
+        self.grace = grace
+        if self.running:
+            self.stopLoop()
+            self.startLoop()
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        self.startLoop()
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self.stopLoop()
+        yield service.BuildbotService.stopService(self)
+
+    def startLoop(self):
+        self.loop = task.LoopingCall(self.collect)
+        self.loop.start(self.interval, now=False).addErrback(
+            log.err, "SharedRepoJanitor: Collection failed")
+
+    def stopLoop(self):
+        if getattr(self, 'loop', None) and self.loop.running:
+            self.loop.stop()
+
+    @defer.inlineCallbacks
+    def findOrphans(self):
+        now = time.time()
+        try:
+            entries = os.listdir(config.sharedrepodir)
+        except OSError as e:
+            log.err(e, "SharedRepoJanitor: Couldn't list %s" % config.sharedrepodir)
+            return []
+
+        def settled(path, since=0):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return False
+            return now - max(mtime, since) > self.grace
+
+        builders = yield self.master.data.get(('builders',))
+        builderids = {b['name']: b['builderid'] for b in builders}
+        # Builds which still have triggered builds (children or a
+        # post-trigger phase) running need their shared repos
+        buildsets = yield self.master.data.get(
+            ('buildsets',), [resultspec.Filter('complete', 'eq', [False])])
+        parents = set(bs['parent_buildid'] for bs in buildsets if bs.get('parent_buildid'))
+
+        orphans = []
+        for entry in entries:
+            path = os.path.join(config.sharedrepodir, entry)
+            m = self.dirre.match(entry)
+            if not m or not os.path.isdir(path):
+                continue
+            buildername, number = m.group(1), int(m.group(2))
+            build = None
+            if buildername in builderids:
+                build = yield self.master.data.get(('builders', builderids[buildername], 'builds', number))
+            if build and (not build['complete'] or build['buildid'] in parents):
+                continue
+            complete_at = build['complete_at'].timestamp() if build and build.get('complete_at') else 0
+            if settled(path, complete_at):
+                orphans.append(path)
+
+        snapshotdir = os.path.join(config.sharedrepodir, "snapshots")
+        if os.path.isdir(snapshotdir):
+            inuse = snapshots.registry.directories()
+            for name in os.listdir(snapshotdir):
+                path = os.path.join(snapshotdir, name)
+                if name not in inuse and settled(path):
+                    orphans.append(path)
+        return orphans
+
+    @defer.inlineCallbacks
+    def collect(self):
+        # Errors mustn't reach the LoopingCall, it would stop collecting
+        try:
+            orphans = yield self.findOrphans()
+        except Exception as e:
+            log.err(e, "SharedRepoJanitor: Couldn't look for orphaned directories")
+            return
+        reclaimed = 0
+        for path in orphans:
+            try:
+                size = yield threads.deferToThread(removeTree, path)
+            except Exception as e:
+                log.err(e, "SharedRepoJanitor: Couldn't remove %s" % path)
+                continue
+            log.msg("SharedRepoJanitor: Removed orphaned %s (%d MB)" % (path, size // (1024 * 1024)))
+            reclaimed += size
+        SharedRepoJanitor.reclaimed += reclaimed
+        MetricCountEvent.log('yoctoabb.janitor.reclaimed_bytes', reclaimed)
+        log.msg("SharedRepoJanitor: Reclaimed %d MB from %d directories, %d MB since start" % (
+                reclaimed // (1024 * 1024), len(orphans), self.reclaimed // (1024 * 1024)))
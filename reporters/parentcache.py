@@ -0,0 +1,101 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.reporters import utils
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from yoctoabb.lib.cache import LRUCache
+
+import weakref
+
+
+class ParentBuildCache(object):
+    """
+    Every child of an a-quick/a-full build looks up the same parent build
+    along with its properties and steps. Keep the enriched parent build dicts
+    for a while so the data API is only queried once per parent, dropping an
+    entry when the parent itself finishes.
+
+    The returned build dicts are shared, callers must not modify them.
+    """
+    neededDetails = dict(wantProperties=True, wantSteps=True)
+    MAX_SIZE = 32
+    TTL = 10 * 60
+
+    def __init__(self, master):
+        self.master = master
+        self.cache = LRUCache(self.MAX_SIZE, ttl=self.TTL)
+        # Deferreds waiting for a build which is already being fetched
+        self.waiting = {}
+        # Builds which finished while being fetched, they mustn't be cached
+        self.finished = set()
+        self.consumer = None
+
+    @defer.inlineCallbacks
+    def startConsuming(self):
+        self.consumer = True
+        try:
+            self.consumer = yield self.master.mq.startConsuming(
+                self.buildFinished,
+                ('builds', None, 'finished'))
+        except Exception:
+            self.consumer = None
+            raise
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stopConsuming)
+
+    def stopConsuming(self):
+        if self.consumer not in (None, True):
+            self.consumer.stopConsuming()
+        self.consumer = None
+
+    def buildFinished(self, key, build):
+        if build['buildid'] in self.waiting:
+            self.finished.add(build['buildid'])
+        if self.cache.pop(build['buildid']) is not None:
+            log.msg("ParentBuildCache: Dropping finished build %s, cache %s" % (build['buildid'], self.cache.stats()))
+
+    @defer.inlineCallbacks
+    def get(self, buildid):
+        if self.consumer is None:
+            yield self.startConsuming()
+
+        build = self.cache.get(buildid)
+        if build is not None:
+            return build
+
+        if buildid in self.waiting:
+            d = defer.Deferred()
+            self.waiting[buildid].append(d)
+            build = yield d
+            return build
+
+        self.waiting[buildid] = []
+        try:
+            build = yield self.master.data.get(("builds", buildid))
+            yield utils.getDetailsForBuild(self.master, build, **self.neededDetails)
+        except Exception as e:
+            self.finished.discard(buildid)
+            for d in self.waiting.pop(buildid):
+                d.errback(e)
+            raise
+        # What we fetched may predate the build finishing
+        if buildid in self.finished:
+            self.finished.discard(buildid)
+        else:
+            self.cache.put(buildid, build)
+        for d in self.waiting.pop(buildid):
+            d.callback(build)
+        return build
+
+
+_caches = weakref.WeakKeyDictionary()
+
+def getParentBuildCache(master):
+    """
+    Return the ParentBuildCache shared by all reporters of 'master'
+    """
+    if master not in _caches:
+        _caches[master] = ParentBuildCache(master)
+    return _caches[master]
@@ -0,0 +1,146 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.data import resultspec
+from buildbot.process.properties import Properties
+from buildbot.util import service
+from twisted.internet import defer
+from twisted.python import log
+
+from yoctoabb.reporters.parentcache import getParentBuildCache
+
+monitored_parents = ['a-full', 'a-quick']
+
+# Properties describing the parent build itself rather than what it built
+skip_properties = ['buildername', 'buildnumber', 'builddir', 'workername',
+                   'workerid', 'scheduler', 'owner', 'owners', 'reason',
+                   'yp_split_parent', 'yp_eta']
+
+# parent_relationship of the buildsets we trigger
+relationship = "Post-trigger steps"
+
+
+class PostTrigger(service.BuildbotService):
+    """
+    With config.split_parent_builds the a-quick/a-full builds trigger their
+    children without waiting for them, freeing their worker. When the
+    triggered buildset completes this starts the parent's post-trigger steps
+    as a build of <parent>-posttrigger with the parent's properties and
+    sourcestamps.
+
+    Buildsets which completed while the master was down are caught up with
+    on start, looking at the last RECOVER builds of each monitored parent.
+    """
+    name = "PostTrigger"
+    RECOVER = 20
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        # Parent build ids whose post-trigger steps were triggered
+        self.continued = set()
+
+        self._buildsetCompleteConsumer = yield self.master.mq.startConsuming(
+            self.buildsetComplete,
+            ('buildsets', None, 'complete'))
+
+        try:
+            yield self.recover()
+        except Exception as e:
+            log.err(e, "PostTrigger: Couldn't look for parents missing their post-trigger steps")
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self._buildsetCompleteConsumer.stopConsuming()
+        yield service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def recover(self):
+        parents = []
+        for buildername in monitored_parents:
+            builders = yield self.master.data.get(
+                ('builders',), [resultspec.Filter('name', 'eq', [buildername])])
+            for builder in builders:
+                builds = yield self.master.data.get(
+                    ('builders', builder['builderid'], 'builds'),
+                    order=['-number'], limit=self.RECOVER)
+                parents.extend(b['buildid'] for b in builds if b['complete'])
+        if not parents:
+            return
+
+        buildsets = yield self.master.data.get(
+            ('buildsets',), [resultspec.Filter('parent_buildid', 'eq', parents)])
+        done = set(bs['parent_buildid'] for bs in buildsets if bs.get('parent_relationship') == relationship)
+        for buildset in buildsets:
+            if buildset['complete'] and buildset['parent_buildid'] not in done:
+                log.msg("PostTrigger: Catching up with buildset %s of build %s" % (buildset['bsid'], buildset['parent_buildid']))
+                yield self.buildsetComplete(None, buildset)
+
+    @defer.inlineCallbacks
+    def buildsetComplete(self, key, buildset):
+        if not buildset.get('parent_buildid'):
+            return
+        # Our own buildsets have the parent build as their parent too
+        if buildset.get('parent_relationship') == relationship:
+            return
+        if buildset['parent_buildid'] in self.continued:
+            return
+        try:
+            parent = yield getParentBuildCache(self.master).get(buildset['parent_buildid'])
+        except Exception as e:
+            log.err(e, "PostTrigger: Couldn't get parent build %s" % buildset['parent_buildid'])
+            return
+        if parent['builder']['name'] not in monitored_parents:
+            return
+        if not parent['properties'].get('yp_split_parent', [False])[0]:
+            return
+
+        schedulername = parent['builder']['name'] + "-posttrigger"
+        scheduler = self.master.scheduler_manager.namedServices.get(schedulername)
+        if scheduler is None:
+            log.msg("PostTrigger: No scheduler %s for build %s" % (schedulername, parent['buildid']))
+            return
+
+        props = Properties()
+        for name, (value, source) in parent['properties'].items():
+            if name not in skip_properties:
+                props.setProperty(name, value, source)
+        props.setProperty("yp_parent_buildername", parent['builder']['name'], self.name)
+        props.setProperty("yp_parent_buildnumber", parent['number'], self.name)
+        props.setProperty("yp_children_results", buildset['results'], self.name)
+        props.setProperty("reason", "Post-trigger steps of %s build %s" % (parent['builder']['name'], parent['number']), self.name)
+
+        try:
+            sourcestamps = yield self.getSourceStamps(parent)
+        except Exception as e:
+            log.err(e, "PostTrigger: Couldn't get sourcestamps of build %s" % parent['buildid'])
+            return
+
+        if parent['buildid'] in self.continued:
+            return
+        self.continued.add(parent['buildid'])
+        log.msg("PostTrigger: Children of %s build %s complete, triggering %s" % (parent['builder']['name'], parent['number'], schedulername))
+        idsDeferred, resultsDeferred = scheduler.trigger(
+            waited_for=False, sourcestamps=sourcestamps, set_props=props,
+            parent_buildid=parent['buildid'], parent_relationship=relationship)
+        try:
+            yield idsDeferred
+        except Exception:
+            self.continued.discard(parent['buildid'])
+            raise
+
+    @defer.inlineCallbacks
+    def getSourceStamps(self, build):
+        request = yield self.master.data.get(('buildrequests', build['buildrequestid']))
+        buildset = yield self.master.data.get(('buildsets', request['buildsetid']))
+        sourcestamps = []
+        for ss in buildset['sourcestamps']:
+            sourcestamps.append({
+                'codebase': ss['codebase'],
+                'repository': ss['repository'],
+                'branch': ss['branch'],
+                'revision': ss['revision'],
+                'project': ss['project'],
+            })
+        return sourcestamps
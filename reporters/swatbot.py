@@ -2,13 +2,20 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
+from buildbot.process.metrics import MetricCountEvent
 from buildbot.reporters import utils
 from buildbot.util import service
-from twisted.internet import defer, threads
-from twisted.python import log
+from twisted.internet import defer, threads, reactor
+from twisted.python import log, threadpool
 from buildbot.process.results import SUCCESS, WARNINGS, FAILURE, SKIPPED, EXCEPTION, RETRY, CANCELLED
 
+from yoctoabb.lib.cache import LRUCache
+from yoctoabb.lib.spool import Spool
+from yoctoabb.reporters.parentcache import getParentBuildCache
+
+import os
 import requests
+import threading
 import time
 import pprint
 import re
@@ -18,17 +25,59 @@ import json
 
 class SwatBotURI(object):
     TIMEOUT = 10
+    # Number of concurrent requests (and persistent connections) to the server
+    POOL_SIZE = 4
+    # Number of buildbot build IDs to remember SwatBot database IDs for
+    CACHE_SIZE = 2000
+    # Responses indicating the server can't create several resources at once,
+    # anything else (e.g. a 400 for one bad item) says nothing about bulk
+    # support
+    BULK_UNSUPPORTED = (404, 405, 501)
 
     def __init__(self, uri, user, passwd):
         self.uri = uri
         self.user = user
         self.passwd = passwd
+        self.headers = None
 
-        self.login()
-
-    def login(self):
+        # All HTTP traffic happens on our own bounded thread pool so the
+        # reactor is never blocked waiting on the SwatBot server. The
+        # requests session is shared between the threads and keeps up to
+        # POOL_SIZE connections alive.
+        self.pool = threadpool.ThreadPool(minthreads=1, maxthreads=self.POOL_SIZE, name="SwatBot")
         self.client = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+        self.client.mount("http://", adapter)
+        self.client.mount("https://", adapter)
+        self.loginLock = threading.Lock()
+
+        # Maps ("collection", buildbot parent buildid) to the BuildCollection
+        # database ID and ("build", buildbot buildid) to the Build database ID
+        self.cache = LRUCache(self.CACHE_SIZE)
+        # Step failures already created one at a time, so a submission
+        # retried after a server error part way through doesn't create them
+        # again
+        self.posted = LRUCache(self.CACHE_SIZE)
+        self.bulk = True
+
+    def start(self):
+        self.pool.start()
+
+    def _stop(self):
+        self.pool.stop()
+        self.client.close()
+
+    def stop(self):
+        """
+        Stop the thread pool, waiting for requests in flight to finish. The
+        threads are joined from a reactor thread pool thread so this doesn't
+        block the reactor.
+        """
+        return threads.deferToThread(self._stop)
+
+    def _login(self):
         self.headers = {'Content-type':'application/vnd.api+json'}
+        self.client.cookies.clear()
 
         req = self.client.get(self.uri + "accounts/login/", timeout=self.TIMEOUT, headers=self.headers)
         login_data = {
@@ -36,29 +85,66 @@ class SwatBotURI(object):
             'password': self.passwd, 
             'csrfmiddlewaretoken': req.cookies['csrftoken'],
         }
-        req2 = self.client.post(self.uri + "accounts/login/", data=login_data, allow_redirects=False)
+        req2 = self.client.post(self.uri + "accounts/login/", data=login_data, timeout=self.TIMEOUT, allow_redirects=False)
         csrftoken = req2.cookies['csrftoken']
         self.headers = {'Content-type':'application/vnd.api+json', 'X-CSRFToken': csrftoken}
 
-    def query_with_login(self, query):
-        req = self.client.get(query, timeout=self.TIMEOUT, headers=self.headers, allow_redirects=False)
+    def _ensure_login(self, stale_headers=None):
+        # Several pool threads can notice an expired login at once, only the
+        # first one should renew it.
+        with self.loginLock:
+            if self.headers is None or self.headers is stale_headers:
+                try:
+                    self._login()
+                except KeyError:
+                    self.headers = None
+                    raise requests.exceptions.RequestException("SwatBot: Login failed, no CSRF token returned")
+
+    def _query_with_login(self, query):
+        self._ensure_login()
+        headers = self.headers
+        req = self.client.get(query, timeout=self.TIMEOUT, headers=headers, allow_redirects=False)
         # A 302 status means we probably need to renew the login
         if req.status_code == requests.codes.found and "login" in req.headers['Location']:
             log.err("SwatBot: Attempting to renew login")
-            self.login()
+            self._ensure_login(headers)
             return self.client.get(query, timeout=self.TIMEOUT, headers=self.headers, allow_redirects=False)
         return req
 
-    def find_build_collection(self, build):
+    def _send(self, method, url, **kwargs):
+        self._ensure_login()
+        return self.client.request(method, url, timeout=self.TIMEOUT, headers=self.headers, **kwargs)
+
+    def query_with_login(self, query):
+        return threads.deferToThreadPool(reactor, self.pool, self._query_with_login, query)
+
+    def post(self, url, **kwargs):
+        return threads.deferToThreadPool(reactor, self.pool, self._send, "POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return threads.deferToThreadPool(reactor, self.pool, self._send, "PATCH", url, **kwargs)
+
+    @staticmethod
+    def check_server_error(req):
+        # Server side errors are likely transient, raise so the event stays
+        # in the spool and is retried later
+        if req.status_code >= 500:
+            raise requests.exceptions.HTTPError("SwatBot: Server error %s" % req.status_code, response=req)
+
+    @defer.inlineCallbacks
+    def find_build_collection(self, record):
         dbid = None
 
         url = self.uri + "rest/buildcollection/"
 
-        collection_build_id = build['buildid']
-        if build['buildset']['parent_buildid']:
-            collection_build_id = build['buildset']['parent_buildid']
+        collection_build_id = record['collection_buildid']
+
+        dbid = self.cache.get(("collection", collection_build_id))
+        if dbid:
+            return dbid
 
-        req = self.query_with_login(url + "?buildid=" + str(collection_build_id))
+        req = yield self.query_with_login(url + "?buildid=" + str(collection_build_id))
+        self.check_server_error(req)
         if req.status_code == requests.codes.ok:
             try:
                 data = req.json()['data']
@@ -66,65 +152,94 @@ class SwatBotURI(object):
                     log.err("SwatBot: More than one buildid matches?: %s" % str(data))
                     return None
                 elif len(data) == 1:
+                    self.cache.put(("collection", collection_build_id), data[0]['id'])
                     return data[0]['id']
             except (json.decoder.JSONDecodeError, KeyError, IndexError) as e:
                 log.err("SwatBot: Couldn't decode json data: %s (ret code %s)" % (req.text, req.status_code))
                 return None
         if req.status_code == requests.codes.not_found or not dbid:
+            if 'branch' not in record:
+                log.err("SwatBot: No details to create BuildCollection for build %s" % collection_build_id)
+                return None
             payload = {
                 'data': {
                     'type': 'BuildCollection',
                     'attributes': {
                         "buildid": collection_build_id,
-                        "targetname": build['builder']['name'],
-                        "branch": build['properties']['branch_poky'][0],
+                        "targetname": record.get('collection_targetname', record['targetname']),
+                        "branch": record['branch'],
                     }
                 }
             }
 
             # We should only get here when a DB entry doesn't exist which means we're the triggering build
             # and should have reason/owner
-            if 'reason' in build['properties'] and build['properties']['reason'][0]:
-                payload['data']['attributes']['reason'] = build['properties']['reason'][0]
-            if 'owner' in build['properties'] and build['properties']['owner'][0]:
-                payload['data']['attributes']['owner'] = build['properties']['owner'][0]
-            if 'swat_monitor' in build['properties'] and build['properties']['swat_monitor'][0]:
-                payload['data']['attributes']['forswat'] = True
-            else:
-                payload['data']['attributes']['forswat'] = False
-
-            try:
-                req = self.client.post(url, json=payload, timeout=self.TIMEOUT, headers=self.headers)
-            except (requests.exceptions.RequestException, requests.exceptions.Timeout):
-                log.err("SwatBot: Unexpected server response exception")
-                return None
+            if record['reason']:
+                payload['data']['attributes']['reason'] = record['reason']
+            if record['owner']:
+                payload['data']['attributes']['owner'] = record['owner']
+            payload['data']['attributes']['forswat'] = record['forswat']
+
+            req = yield self.post(url, json=payload)
+            self.check_server_error(req)
             if req.status_code != requests.codes.created:
-                log.err("SwatBot: Couldn't create: %s (%s)" % (str(req.status_code), str(req.json())))
+                log.err("SwatBot: Couldn't create: %s (%s)" % (str(req.status_code), req.text))
                 return None
             data = req.json()['data']
+            self.cache.put(("collection", collection_build_id), data['id'])
             return data['id']
         if not dbid:
-            log.err("SwatBot: Unexpected server response: %s (%s)" % (str(req.status_code), str(req.json())))
+            log.err("SwatBot: Unexpected server response: %s (%s)" % (str(req.status_code), req.text))
             return None
 
         return dbid
 
-    def add_build(self, build):
+    @defer.inlineCallbacks
+    def find_build(self, buildid):
+        dbid = self.cache.get(("build", buildid))
+        if dbid:
+            return dbid
+
+        req = yield self.query_with_login(self.uri + "rest/build/?buildid=" + str(buildid))
+        self.check_server_error(req)
+        if req.status_code != requests.codes.ok:
+            log.err("SwatBot: Couldn't find build: %s (%s)" % (str(req.status_code), req.text))
+            return None
+
+        try:
+            data = req.json()['data']
+        except (json.decoder.JSONDecodeError, KeyError, IndexError) as e:
+            log.err("SwatBot: Couldn't decode json data: %s (ret code %s)" % (req.text, req.status_code))
+            return None
+
+        if len(data) != 1:
+            log.err("SwatBot: More than one buildid matches?: %s" % str(data))
+            return None
+        self.cache.put(("build", buildid), data[0]['id'])
+        return data[0]['id']
+
+    @defer.inlineCallbacks
+    def add_build(self, record):
         url = self.uri + "rest/build/"
 
         dbid = None
-        collectionid = self.find_build_collection(build)
+        collectionid = yield self.find_build_collection(record)
         if not collectionid:
             log.err("SwatBot: Couldn't find BuildCollection database ID")
             return False
 
-        req = self.query_with_login(url + "?buildid=" + str(build['buildid']))
+        req = yield self.query_with_login(url + "?buildid=" + str(record['buildid']))
+        self.check_server_error(req)
         if req.status_code == requests.codes.ok:
             data = req.json()['data']
             if len(data) > 1:
                 log.err("SwatBot: More than one buildid matches?: %s" % str(data))
                 return False
             elif len(data) == 1:
+                if 'results' in record:
+                    # Created before a restart, the finish still needs sending
+                    result = yield self.update_build(record)
+                    return result
                 log.err("SwatBot: Build already exists?: %s" % str(data))
                 return False
 
@@ -132,11 +247,11 @@ class SwatBotURI(object):
             'data': {
                 'type': 'Build',
                 'attributes': {
-                    "buildid": build['buildid'],
-                    "url": build['url'],
-                    "targetname": build['builder']['name'],
-                    "started": build['started_at'].isoformat(),
-                    "workername": build['properties']['workername'][0],
+                    "buildid": record['buildid'],
+                    "url": record['url'],
+                    "targetname": record['targetname'],
+                    "started": record['started'],
+                    "workername": record['workername'],
                     "buildcollection": {
                         "type": "BuildCollection",
                         "id" :int(collectionid)
@@ -145,98 +260,161 @@ class SwatBotURI(object):
             }
         }
 
-        req = self.client.post(url, json=payload, timeout=self.TIMEOUT, headers=self.headers)
+        if 'results' in record:
+            # Started and finished within one batch of the spool
+            payload['data']['attributes'].update(self.finished_attributes(record))
+
+        req = yield self.post(url, json=payload)
+        self.check_server_error(req)
         if req.status_code != requests.codes.created:
-            log.err("SwatBot: Couldn't create: %s (%s)" % (str(req.status_code), str(req.json())))
+            log.err("SwatBot: Couldn't create: %s (%s)" % (str(req.status_code), req.text))
             return False
+        try:
+            self.cache.put(("build", record['buildid']), req.json()['data']['id'])
+        except (json.decoder.JSONDecodeError, KeyError):
+            log.msg("SwatBot: No database ID in response for build %s, will look it up" % record['buildid'])
         return True
 
     @defer.inlineCallbacks
-    def update_build(self, build, master):
-        req = self.query_with_login(self.uri + "rest/build/?buildid=" + str(build['buildid']))
-        if req.status_code != requests.codes.ok:
-            log.err("SwatBot: Couldn't find build to update: %s (%s)" % (str(req.status_code), str(req.json())))
-            return False
-
-        try:
-            data = req.json()['data']
-        except (json.decoder.JSONDecodeError, KeyError, IndexError) as e:
-            log.err("SwatBot: Couldn't decode json data: %s (ret code %s)" % (req.text, req.status_code))
-            return False
-
-        if len(data) != 1:
-            log.err("SwatBot: More than one buildid matches?: %s" % str(data))
+    def update_build(self, record):
+        dbid = yield self.find_build(record['buildid'])
+        if not dbid:
+            log.err("SwatBot: Couldn't find build to update: %s" % str(record))
             return False
 
-        dbid = data[0]['id']
         url = self.uri + "rest/build/" + str(dbid) + "/"
 
+        # Only send the fields we change so edits made on the server since
+        # the build started (e.g. triage) are left alone
         payload = {
             'data': {
                 'id': int(dbid),
                 'type': 'Build',
-                'attributes': data[0]['attributes'],
+                'attributes': self.finished_attributes(record),
             }
         }
 
-        payload['data']['attributes']['status'] = build['results']
-        payload['data']['attributes']['completed'] = build['complete_at'].isoformat()
-        if "yp_build_revision" in build['properties']:
-            payload['data']['attributes']['revision'] = build['properties']['yp_build_revision'][0]
-
-        req = self.client.put(url, json=payload, timeout=self.TIMEOUT, headers=self.headers)
+        req = yield self.patch(url, json=payload)
+        self.check_server_error(req)
         if req.status_code != requests.codes.ok:
-            log.err("SwatBot: Couldn't update record: %s %s (%s)" % (str(build), str(req.status_code), str(req.json())))
+            log.err("SwatBot: Couldn't update record: %s %s (%s)" % (str(record), str(req.status_code), req.text))
             return False
+        return True
 
-        for s in build['steps']:
-            # Ignore logs for steps which succeeded/cancelled
-            result = s['results']
-            if result in (SUCCESS, RETRY, CANCELLED, SKIPPED):
-                continue
-
-            # Log for FAILURE, EXCEPTION, WARNING
-            step_name = s['name']
-            step_number = s['number']
-            logs = yield master.data.get(("steps", s['stepid'], 'logs'))
-            logs = list(logs)
-            urls = []
-            for l in logs:
-                urls.append('%s/steps/%s/logs/%s' % (build['url'], step_number, l['name'].replace(" ", "_")))
-            if urls:
-                urls = " ".join(urls)
-            else:
-                urls = ""
-            payload = {
-                'data': {
-                    'type': 'StepFailure',
-                    'attributes': {
-                        "urls": urls,
-                        "status": s['results'],
-                        "stepname": s['name'],
-                        "stepnumber": s['number'],
-                        "build": {
-                            "type": "Build",
-                            "id": int(dbid),
-                        }
-                    }
+    @staticmethod
+    def finished_attributes(record):
+        attributes = {
+            "status": record['results'],
+            "completed": record['completed'],
+        }
+        if record['revision']:
+            attributes['revision'] = record['revision']
+        return attributes
+
+    def failure_payload(self, failure, dbid):
+        return {
+            'type': 'StepFailure',
+            'attributes': {
+                "urls": failure['urls'],
+                "status": failure['status'],
+                "stepname": failure['stepname'],
+                "stepnumber": failure['stepnumber'],
+                "build": {
+                    "type": "Build",
+                    "id": int(dbid),
                 }
             }
+        }
 
-            req = self.client.post(self.uri + "rest/stepfailure/", json=payload, timeout=self.TIMEOUT, headers=self.headers)
+    @defer.inlineCallbacks
+    def add_step_failures(self, builds):
+        """
+        Create the StepFailure records of one or more builds, given as a list
+        of {'buildid', 'failures'} records
+        """
+        failures = []
+        found = False
+        for record in builds:
+            dbid = yield self.find_build(record['buildid'])
+            if not dbid:
+                log.err("SwatBot: Couldn't find build for failure entries: %s" % str(record))
+                continue
+            found = True
+            for f in record['failures']:
+                if (dbid, f['stepnumber']) not in self.posted:
+                    failures.append(self.failure_payload(f, dbid))
+        if not failures:
+            return found
+
+        url = self.uri + "rest/stepfailure/"
+
+        # Send all the failures in one request when the server
+        # accepts a list of resources, fall back to one request per failure
+        # if it doesn't.
+        rejected = False
+        if self.bulk and len(failures) > 1:
+            req = yield self.post(url, json={'data': failures})
+            if req.status_code == requests.codes.created:
+                return True
+            if req.status_code in self.BULK_UNSUPPORTED:
+                log.msg("SwatBot: Server doesn't support bulk step failures (%s), disabling" % req.status_code)
+                self.bulk = False
+            else:
+                self.check_server_error(req)
+                # Most likely a 400 for the list body, find out by sending
+                # the failures one by one
+                log.msg("SwatBot: Bulk step failures rejected (%s), sending them one by one: %s" % (req.status_code, req.text))
+                rejected = True
+
+        result = True
+        for payload in failures:
+            req = yield self.post(url, json={'data': payload})
+            self.check_server_error(req)
             if req.status_code != requests.codes.created:
-                log.err("SwatBot: Couldn't create failure entry: Step data: %s" % (str(s)))
                 log.err("SwatBot: Couldn't create failure entry: Payload: %s" % (str(payload)))
                 log.err("SwatBot: Couldn't create failure entry: %s %s" % (str(req.status_code), str(req.headers)))
-        return True
+                result = False
+                continue
+            attributes = payload['attributes']
+            self.posted.put((attributes['build']['id'], attributes['stepnumber']), True)
+        if rejected and result:
+            # The same failures were accepted individually, so it was the list
+            log.msg("SwatBot: Server doesn't accept lists of step failures, disabling bulk submission")
+            self.bulk = False
+        return result
+
+    def submit(self, kind, record):
+        """
+        Send a submission made from spooled events (see SwatBot.coalesce) to
+        the server. The Deferred fires with False if the server rejected it
+        and fails with a RequestException if it should be retried.
+        """
+        if kind == "build":
+            return self.add_build(record)
+        elif kind == "buildfinished":
+            return self.update_build(record)
+        elif kind == "stepfailures":
+            return self.add_step_failures(record['builds'])
+        log.err("SwatBot: Unknown spooled event type %s" % kind)
+        return defer.succeed(False)
 
 
 class SwatBot(service.BuildbotService):
     name = "SwatBot"
+    helper = None
+    spool = None
 
     neededDetails = dict(wantProperties=True, wantSteps=True)
     # wantPreviousBuilds wantLogs
 
+    # Number of spooled events read and submitted per pass of the drainer
+    BATCH_SIZE = 50
+    # Number of step log listings fetched from the data API at once
+    LOG_CONCURRENCY = 8
+    # Retry delays (seconds) when the server can't be reached
+    MIN_BACKOFF = 5
+    MAX_BACKOFF = 10 * 60
+
     def checkConfig(self, bot_uri, user, password, **kwargs):
         service.BuildbotService.checkConfig(self)
 
@@ -246,11 +424,24 @@ class SwatBot(service.BuildbotService):
         self.uri = bot_uri
         self.user = user
         self.passwd = password
+        if self.helper:
+            yield self.helper.stop()
         self.helper = SwatBotURI(self.uri, self.user, self.passwd)
+        if self.running:
+            self.helper.start()
+            self.wakeDrainer()
 
     @defer.inlineCallbacks
     def startService(self):
         yield service.BuildbotService.startService(self)
+        self.helper.start()
+
+        # Keep outbound events next to the master's state.sqlite
+        self.spool = Spool(os.path.join(self.master.basedir, "swatbot-spool.sqlite"))
+        self.draining = False
+        self.backoff = 0
+        self.retryTimer = None
+        self.logLimit = defer.DeferredSemaphore(self.LOG_CONCURRENCY)
 
         startConsuming = self.master.mq.startConsuming
         self._buildCompleteConsumer = yield startConsuming(
@@ -261,20 +452,190 @@ class SwatBot(service.BuildbotService):
             self.buildStarted,
             ('builds', None, 'new'))
 
+        # Replay anything left over from before a restart
+        self.wakeDrainer()
+
+    @defer.inlineCallbacks
     def stopService(self):
         self._buildCompleteConsumer.stopConsuming()
         self._buildStartedConsumer.stopConsuming()
+        if self.retryTimer and self.retryTimer.active():
+            self.retryTimer.cancel()
+        yield self.helper.stop()
+        self.spool.close()
+        yield service.BuildbotService.stopService(self)
+
+    def wakeDrainer(self):
+        # While backing off the pending retry timer will restart draining
+        if self.draining or (self.retryTimer and self.retryTimer.active()):
+            return
+        self.drain()
+
+    @staticmethod
+    def coalesce(events):
+        """
+        Turn a batch of spooled events into as few submissions as possible,
+        returned as (eventids, kind, record) in the order they have to be
+        sent. A build which both started and finished within the batch is
+        created complete, and the step failures of all the builds in the
+        batch go in a single submission after the builds they belong to.
+        Builds and collections are still created one at a time, later
+        events need the database IDs the server assigns them.
+        """
+        submissions = []
+        started = {}
+        failures = None
+        for eventid, kind, record in events:
+            if kind == "buildfinished" and record['buildid'] in started:
+                eventids, _, build = started.pop(record['buildid'])
+                eventids.append(eventid)
+                build.update(record)
+                continue
+            if kind in ("stepfailures", "stepfailure"):
+                if kind == "stepfailure":
+                    # Single failure events spooled by older versions
+                    record = {'buildid': record['buildid'], 'failures': [record]}
+                if failures is None:
+                    failures = ([], "stepfailures", {'builds': []})
+                failures[0].append(eventid)
+                failures[2]['builds'].append(record)
+                continue
+            submission = ([eventid], kind, record)
+            if kind == "build":
+                started[record['buildid']] = submission
+            submissions.append(submission)
+        if failures:
+            submissions.append(failures)
+        return submissions
+
+    @defer.inlineCallbacks
+    def drain(self):
+        self.draining = True
+        try:
+            while self.running:
+                events = yield self.spool.peek(self.BATCH_SIZE)
+                if not events:
+                    break
+                done = []
+                failed = False
+                for eventids, kind, record in self.coalesce(events):
+                    try:
+                        result = yield self.helper.submit(kind, record)
+                    except requests.RequestException as e:
+                        # Connection problems and server errors are worth
+                        # retrying, the events stay in the spool
+                        log.err("SwatBot: Couldn't submit %s event, will retry: %s" % (kind, e))
+                        failed = True
+                        break
+                    except Exception as e:
+                        # Anything else would fail the same way every time
+                        # and block the events queued behind it for good
+                        log.err(e, "SwatBot: Couldn't submit %s event" % kind)
+                        result = False
+                    if not result:
+                        log.err("SwatBot: Dropping %s event: %s" % (kind, str(record)))
+                    done.extend(eventids)
+                if done:
+                    yield self.spool.remove(done)
+                    stats = self.helper.cache.stats()
+                    MetricCountEvent.log('yoctoabb.swatbot.idcache.hits', stats['hits'], absolute=True)
+                    MetricCountEvent.log('yoctoabb.swatbot.idcache.misses', stats['misses'], absolute=True)
+                    log.msg("SwatBot: Submitted %s events, ID cache %s" % (len(done), stats))
+                if failed:
+                    self.backoff = min(max(self.backoff * 2, self.MIN_BACKOFF), self.MAX_BACKOFF)
+                    self.retryTimer = reactor.callLater(self.backoff, self.wakeDrainer)
+                    break
+                self.backoff = 0
+        except Exception as e:
+            log.err(e, "SwatBot: Spool drainer failed")
+        finally:
+            self.draining = False
+
+    @staticmethod
+    def getProperty(build, name, default=None):
+        if name in build['properties']:
+            return build['properties'][name][0]
+        return default
 
     @defer.inlineCallbacks
     def buildStarted(self, key, build):
         yield utils.getDetailsForBuild(self.master, build, **self.neededDetails)
         #log.err("SwatBot: buildStarted %s %s" % (key, pprint.pformat(build)))
-        self.helper.add_build(build)
+
+        record = {
+            "buildid": build['buildid'],
+            "collection_buildid": build['buildset']['parent_buildid'] or build['buildid'],
+            "url": build['url'],
+            "targetname": build['builder']['name'],
+            "started": build['started_at'].isoformat(),
+            "workername": self.getProperty(build, 'workername'),
+        }
+
+        # The BuildCollection describes the triggering build. Its details are
+        # only needed to create it, which the parent's own start event
+        # normally did already.
+        collection = build
+        if build['buildset']['parent_buildid']:
+            if ("collection", record['collection_buildid']) in self.helper.cache:
+                collection = None
+            else:
+                collection = yield getParentBuildCache(self.master).get(build['buildset']['parent_buildid'])
+        if collection:
+            record.update({
+                "collection_targetname": collection['builder']['name'],
+                "branch": self.getProperty(collection, 'branch_poky'),
+                "reason": self.getProperty(collection, 'reason'),
+                "owner": self.getProperty(collection, 'owner'),
+                "forswat": bool(self.getProperty(collection, 'swat_monitor')),
+            })
+        yield self.spool.put("build", record)
+        self.wakeDrainer()
 
     # Assume we only have a parent, doesn't handle builds nested more than one level.
     @defer.inlineCallbacks
     def buildFinished(self, key, build):
         yield utils.getDetailsForBuild(self.master, build, **self.neededDetails)
         #log.err("SwatBot: buildFinished %s %s" % (key, pprint.pformat(build)))
-        yield self.helper.update_build(build, self.master)
+        record = {
+            "buildid": build['buildid'],
+            "results": build['results'],
+            "completed": build['complete_at'].isoformat(),
+            "revision": self.getProperty(build, 'yp_build_revision'),
+        }
+        try:
+            yield self.spool.put("buildfinished", record)
 
+            # Ignore logs for steps which succeeded/cancelled
+            # Log for FAILURE, EXCEPTION, WARNING
+            failed = [s for s in build['steps'] if s['results'] not in (SUCCESS, RETRY, CANCELLED, SKIPPED)]
+            if failed:
+                failures = yield defer.gatherResults(
+                    [self.logLimit.run(self.getStepFailure, build, s) for s in failed],
+                    consumeErrors=True)
+                yield self.spool.put("stepfailures", {"buildid": build['buildid'], "failures": failures})
+        finally:
+            self.wakeDrainer()
+
+    @defer.inlineCallbacks
+    def getStepFailure(self, build, s):
+        step_number = s['number']
+        try:
+            logs = yield self.master.data.get(("steps", s['stepid'], 'logs'))
+            logs = list(logs)
+        except Exception as e:
+            # Still report the failure, just without links to its logs
+            log.err(e, "SwatBot: Couldn't list logs of step %s" % s['stepid'])
+            logs = []
+        urls = []
+        for l in logs:
+            urls.append('%s/steps/%s/logs/%s' % (build['url'], step_number, l['name'].replace(" ", "_")))
+        if urls:
+            urls = " ".join(urls)
+        else:
+            urls = ""
+        return {
+            "urls": urls,
+            "status": s['results'],
+            "stepname": s['name'],
+            "stepnumber": s['number'],
+        }
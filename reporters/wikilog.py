@@ -4,12 +4,14 @@
 
 from buildbot.reporters import utils
 from buildbot.util import service
-from twisted.internet import defer, threads
+from twisted.internet import defer, reactor
 from twisted.python import log
 from buildbot.process.results import SUCCESS, WARNINGS, FAILURE, SKIPPED, EXCEPTION, RETRY, CANCELLED
 
-from yoctoabb.lib.wiki import YPWiki
+from yoctoabb.lib.wiki import YPWiki, BuildLogPage, EditConflict
+from yoctoabb.reporters.parentcache import getParentBuildCache
 
+from collections import OrderedDict
 import time
 import pprint
 import re
@@ -22,14 +24,16 @@ class WikiLog(service.BuildbotService):
     # wantPreviousBuilds wantLogs
     neededDetails = dict(wantProperties=True, wantSteps=True)
     wikiLock = None
+    # Attempts at updating an entry which conflicts with other edits
+    EDIT_TRIES = 3
 
     def checkConfig(self, wiki_uri, wiki_un, wiki_pass, wiki_page,
-                    identifier=None, **kwargs):
+                    identifier=None, write_window=30, max_pending=100, **kwargs):
         service.BuildbotService.checkConfig(self)
 
     @defer.inlineCallbacks
     def reconfigService(self, wiki_uri, wiki_un, wiki_pass, wiki_page,
-                        identifier=None, **kwargs):
+                        identifier=None, write_window=30, max_pending=100, **kwargs):
         yield service.BuildbotService.reconfigService(self)
         self.wiki_page = wiki_page
         self.identifier = None
@@ -38,7 +42,20 @@ class WikiLog(service.BuildbotService):
             self.identifier = identifier.replace(" ", "-")
             self.idstring = " on " + self.identifier
         self.wiki = YPWiki(wiki_uri, wiki_un, wiki_pass)
-        self.wikiLock = defer.DeferredLock()
+        self.page = None
+        # Writes are queued for up to write_window seconds (or until
+        # max_pending are queued) and then merged into as few wiki edits as
+        # possible
+        self.write_window = write_window
+        self.max_pending = max_pending
+        # Writes queued (and the lock ordering the batches being written)
+        # carry over a reconfig, the pending flush picks up the new settings
+        if self.wikiLock is None:
+            self.wikiLock = defer.DeferredLock()
+            self.pending = []
+            self.flushTimer = None
+        elif len(self.pending) >= self.max_pending:
+            self.flush()
 
     @defer.inlineCallbacks
     def startService(self):
@@ -53,9 +70,77 @@ class WikiLog(service.BuildbotService):
             self.buildStarted,
             ('builds', None, 'new'))
 
+    @defer.inlineCallbacks
     def stopService(self):
         self._buildCompleteConsumer.stopConsuming()
         self._buildStartedConsumer.stopConsuming()
+        yield self.flush()
+        yield service.BuildbotService.stopService(self)
+
+    def queueWrite(self, kind, build, parent=None, logentry=None):
+        self.pending.append((kind, build, parent, logentry))
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+        elif not self.flushTimer:
+            # The timer isn't pushed back by later writes so no write waits
+            # longer than write_window
+            self.flushTimer = reactor.callLater(self.write_window, self.flush)
+
+    @defer.inlineCallbacks
+    def flush(self):
+        if self.flushTimer and self.flushTimer.active():
+            self.flushTimer.cancel()
+        self.flushTimer = None
+
+        ops = self.pending
+        self.pending = []
+        if not ops:
+            return
+
+        # The lock keeps batches in the order they were queued
+        yield self.wikiLock.acquire()
+        try:
+            yield self.writeOps(ops)
+        except Exception as e:
+            log.err(e, "wkl: Failed to write queued wikilog changes")
+        finally:
+            self.wikiLock.release()
+
+    @defer.inlineCallbacks
+    def writeOps(self, ops):
+        """
+        Apply a batch of queued writes with one edit for all new entries
+        followed by one edit per entry being updated. New entries always go
+        first so updates can find the entries they refer to.
+        """
+        new_builds = [build for kind, build, parent, logentry in ops if kind == 'log']
+        failed = set()
+        logged = True
+        if new_builds:
+            logged = yield self.logBuilds(new_builds)
+        if not logged:
+            for build in new_builds:
+                log.err("wkl: Failed to log build %s on %s" % (
+                    build['buildid'], build['builder']['name']))
+                failed.add(build['buildid'])
+
+        # Merge updates to the same entry, keeping them in the order received
+        updates = OrderedDict()
+        for kind, build, parent, logentry in ops:
+            if kind != 'update' or build['buildid'] in failed:
+                continue
+            if not parent:
+                parent = build
+            if parent['url'] not in updates:
+                updates[parent['url']] = (parent, [], [])
+            updates[parent['url']][1].append(build)
+            updates[parent['url']][2].append(logentry)
+
+        for parent, builds, logentries in updates.values():
+            update = yield self.updateBuild(builds, parent, ''.join(logentries))
+            if not update:
+                log.err("wkl: Failed to update wikilog with build %s failure" %
+                        ', '.join(str(build['buildid']) for build in builds))
 
     @defer.inlineCallbacks
     def buildStarted(self, key, build):
@@ -67,15 +152,7 @@ class WikiLog(service.BuildbotService):
             # Only log full/quick builds on the wiki log
             if build['builder']['name'] not in monitored_parents:
                 return
-            yield self.wikiLock.acquire()
-            try:
-                result = yield threads.deferToThread(self.logBuild, build)
-            finally:
-                self.wikiLock.release()
-
-            if not result:
-                log.err("wkl: Failed to log build %s on %s" % (
-                    build['buildid'], build['builder']['name']))
+            self.queueWrite('log', build)
 
     # Assume we only have a parent, doesn't handle builds nested more than one level.
     @defer.inlineCallbacks
@@ -85,8 +162,7 @@ class WikiLog(service.BuildbotService):
 
         parent = None
         if build['buildset']['parent_buildid']:
-            parent = yield self.master.data.get(("builds", build['buildset']['parent_buildid']))
-            yield utils.getDetailsForBuild(self.master, parent, **self.neededDetails)
+            parent = yield getParentBuildCache(self.master).get(build['buildset']['parent_buildid'])
 
         # Only run the logging code for builds in the monitored_parents list, or builds with
         # failures (to try and cut down on wiki noise)
@@ -103,30 +179,14 @@ class WikiLog(service.BuildbotService):
             return
 
         if not headerpresent:
-            yield self.wikiLock.acquire()
-            try:
-                result = yield threads.deferToThread(self.logBuild, build)
-            finally:
-                self.wikiLock.release()
-
-            if not result:
-                log.err("wkl: Failed to log build failure %s on %s" % (
-                    build['buildid'], build['builder']['name']))
-                return
+            self.queueWrite('log', build)
 
         entry = yield self.getEntry(build, parent)
-        yield self.wikiLock.acquire()
-        try:
-            update = yield threads.deferToThread(self.updateBuild, build, parent, entry)
-        finally:
-            self.wikiLock.release()
-        if not update:
-            log.err("wkl: Failed to update wikilog with build %s failure" %
-                    build['buildid'])
+        self.queueWrite('update', build, parent, entry)
 
-    def logBuild(self, build):
+    def formatEntry(self, build):
         """
-        Extract information about 'build' and post an entry to the wiki
+        Extract information about 'build' and format a new wiki entry for it
 
         @type   build:  buildbot.status.build.BuildStatus
         """
@@ -151,38 +211,87 @@ class WikiLog(service.BuildbotService):
             forcedby = build['properties']['owner'][0]
         starttime = start.ctime()
 
-        sectionfmt = '==[{} {} {} - {} {}{}]=='
-        section_title = sectionfmt.format(url, builder, buildid, buildbranch, chash, self.idstring)
-        summaryfmt = 'Adding new BuildLog entry for build %s (%s)'
-        summary = summaryfmt % (buildid, chash)
-        summary = summary + self.idstring
+        titlefmt = '{} {} {} - {} {}{}'
+        title = titlefmt.format(url, builder, buildid, buildbranch, chash, self.idstring)
+        section_title = '==[' + title + ']=='
         content = '<div id="' + str(buildid) + '"></div>\n'
         content = content + "* '''Build ID''' - %s" % chash
         content = content + self.idstring
         content = content + '\n* Started at: %s\n' % starttime
         content = content + '* ' + forcedby + '\n* ' + reason + '\n'
         new_entry = '{}\n{}\n'.format(section_title, content)
+        return title, new_entry, chash
 
-        blurb, entries, footer = self.wiki.get_content(self.wiki_page)
-        if not blurb:
-            log.err("wkl: Unexpected content retrieved from wiki!")
-            return False
+    @defer.inlineCallbacks
+    def logBuilds(self, builds):
+        """
+        Post new entries for 'builds' to the wiki in a single edit, the most
+        recent build ending up at the top of the page
+        """
+
+        entries = []
+        titles = []
+        hashes = []
+        for build in builds:
+            title, new_entry, chash = self.formatEntry(build)
+            entries.insert(0, new_entry)
+            titles.append(title)
+            hashes.append('%s (%s)' % (build['buildid'], chash))
+        new_entry = ''.join(entries)
+        buildids = ', '.join(str(build['buildid']) for build in builds)
+
+        if len(builds) == 1:
+            summary = 'Adding new BuildLog entry for build %s' % hashes[0]
+        else:
+            summary = 'Adding new BuildLog entries for builds %s' % ', '.join(hashes)
+        summary = summary + self.idstring
 
-        content = blurb + new_entry + entries + footer
-        cookies = self.wiki.login()
+        cookies = yield self.wiki.login()
 
         if not cookies:
             log.err("wkl: Failed to login to wiki")
             return False
 
-        post = self.wiki.post_entry(self.wiki_page, content, summary, cookies)
+        page = yield self.getPage()
+        if not page:
+            log.err("wkl: Unexpected content retrieved from wiki!")
+            return False
+
+        if not page.count:
+            # The page is new or empty, write it with the blurb and footer
+            # around our entries
+            content = page.blurb + new_entry + page.footer
+            post = yield self.wiki.post_entry(self.wiki_page, content, summary, cookies)
+        else:
+            # Section 0 is the blurb, appending to it places the new entry
+            # above all of the existing ones without sending the whole page
+            post = yield self.wiki.edit_section(self.wiki_page, 0, summary, cookies,
+                                                appendtext="\n" + new_entry)
         if not post:
-            log.err("wkl: Failed to post entry for %s" % buildid)
+            # We don't know what state the page was left in
+            self.page = None
+            log.err("wkl: Failed to post entry for %s" % buildids)
             return False
 
-        log.msg("wkl: Posting wikilog entry for %s" % buildid)
+        for title in titles:
+            page.add(title)
+
+        log.msg("wkl: Posting wikilog entry for %s" % buildids)
         return True
 
+    @defer.inlineCallbacks
+    def getPage(self):
+        """
+        Return the index of the entries on the BuildLog page, the page is only
+        downloaded and parsed when there's no valid index
+        """
+        if self.page is None:
+            blurb, entries, footer, _ = yield self.wiki.get_content(self.wiki_page)
+            if not blurb:
+                return None
+            self.page = BuildLogPage(blurb, entries, footer)
+        return self.page
+
     def updateEntryBuildInfo(self, entry, title, build):
         """
         Extract the branch and commit hash from the properties of the 'build'
@@ -243,16 +352,14 @@ class WikiLog(service.BuildbotService):
             logentry = logentry + '\n* [%s %s] %s failed: %s' % (url, builder, step_name, logs)
         return logentry
 
-    def updateBuild(self, build, parent, logentry):
-
-        if not parent:
-            parent = build
-        buildid = build['buildid']
-        builder = build['builder']['name']
-
-        log.err("wkl: Starting to update entry for %s(%s)" % (buildid, parent['buildid']))
-
-        blurb, entries, footer = self.wiki.get_content(self.wiki_page)
+    @defer.inlineCallbacks
+    def archiveEntries(self):
+        """
+        Move older entries off to a new archive page when the log becomes too
+        long. This rewrites the whole page but only happens every 150 or so
+        builds.
+        """
+        blurb, entries, footer, timestamps = yield self.wiki.get_content(self.wiki_page)
         if not blurb:
             log.err("wkl: Unexpected content retrieved from wiki!")
             return False
@@ -261,101 +368,139 @@ class WikiLog(service.BuildbotService):
 
         # [1::2] selects only the odd entries, i.e. separators/titles
         titles = entry_list[1::2]
-        if len(titles) > 200:
-            # Archive off entries when the log becomes too long
+        log.err("wkl: Archiving off entries from %s (size %s)" % (titles[50], len(titles)))
 
-            log.err("wkl: Archiving off entries from %s (size %s)" % (titles[50], len(titles)))
+        sep = '==[' + titles[50] + ']=='
+        head, archive = entries.split(sep, 1)
+        archive = sep + archive
 
-            sep = '==[' + titles[50] + ']=='
-            head, archive = entries.split(sep, 1)
-            archive = sep + archive
+        archivenum = int(max(re.findall(r'\[%s/Archive/([0-9]+)\]' % self.wiki_page, footer)))
+        nextnum = str(archivenum + 1).zfill(4)
 
+        cookies = yield self.wiki.login()
+        if not cookies:
+            log.err("wkl: Failed to login to wiki")
+            return False
 
-            archivenum = int(max(re.findall(r'\[%s/Archive/([0-9]+)\]' % self.wiki_page, footer)))
-            nextnum = str(archivenum + 1).zfill(4)
+        post = yield self.wiki.post_entry(self.wiki_page + "/Archive/" + nextnum, archive, "Archive out older buildlog entries", cookies)
+        if not post:
+            log.err("wkl: Failed to save new archive page %s" % (nextnum))
+            return False
 
-            cookies = self.wiki.login()
-            if not cookies:
-                log.err("wkl: Failed to login to wiki")
-                return False
+        footer = footer + "\n* [[" + self.wiki_page + "/Archive/" + nextnum + "]]"
 
-            post = self.wiki.post_entry(self.wiki_page + "/Archive/" + nextnum, archive, "Archive out older buildlog entries", cookies)
-            if not post:
-                log.err("wkl: Failed to save new archive page %s" % (nextnum))
-                return False
+        # With the timestamps the wiki merges in (or refuses the edit over)
+        # entries other masters added since we read the page
+        try:
+            post = yield self.wiki.post_entry(self.wiki_page, blurb + head + footer, "Archive out older buildlog entries",
+                                              cookies, **timestamps)
+        except EditConflict:
+            log.msg("wkl: %s changed while archiving entries, will try again later" % (self.wiki_page))
+            return False
+        if not post:
+            log.err("wkl: Failed to remove archived entries from %s" % (self.wiki_page))
+            return False
+        return True
+
+    @defer.inlineCallbacks
+    def findEntry(self, parent):
+        """
+        Find the entry for 'parent' and fetch its section of the page. Returns
+        the page index, the entry, the section text and the timestamps to
+        edit the section with.
+        """
+        # If the section doesn't contain the entry we expect the page was
+        # changed behind our back, reload the index and try again
+        for attempt in range(2):
+            page = yield self.getPage()
+            if not page:
+                log.err("wkl: Unexpected content retrieved from wiki!")
+                return None, None, None, None
+
+            entry = page.find(parent['url'], self.identifier)
+            if not entry:
+                return page, None, None, None
+
+            text, timestamps = yield self.wiki.get_section(self.wiki_page, page.section(entry))
+            m = BuildLogPage.title_re.match(text or '')
+            if m and m.group(1) == entry.title:
+                return page, entry, text, timestamps
+            self.page = None
+        return page, None, None, None
+
+    @defer.inlineCallbacks
+    def updateBuild(self, builds, parent, logentry):
+        """
+        Add 'logentry', the failures of 'builds', to the wiki entry of
+        'parent'
+        """
 
-            entries = head
-            entry_list = re.split('\=\=\[(.+)\]\=\=.*', entries)
-
-            footer = footer + "\n* [[" + self.wiki_page + "/Archive/" + nextnum + "]]"
-
-        entry = ''
-        title = ''
-        foundmatch = False
-        # Start at the beginning of entry list and keep iterating until we find
-        # a title which contains our url/identifier
-        for idx, entry in enumerate(entry_list):
-            # The matched title contents should always start with a http*
-            # schemed URI
-            if entry.startswith('http'):
-                # format of the title is:
-                # ==[url builder buildid - buildbranch commit_hash on identifier]==
-                title_components = entry.split(None, 8)
-
-                if title_components[0] == parent['url']:
-                    if self.identifier and title_components[7] == self.identifier:
-                        foundmatch = True
-                    elif not self.identifier:
-                        foundmatch = True
-
-                if foundmatch:
-                    entry = entry_list[idx+1]
-                    title = entry_list[idx]
-                    break
-
-        if not entry or not title:
-            errmsg = ("wkl: Failed to update entry for {0} couldn't find a matching title containing url: {1}")
-            log.err(errmsg.format(buildid, parent['url']))
+        buildid = ', '.join(str(build['buildid']) for build in builds)
+        builder = ', '.join(OrderedDict((build['builder']['name'], None) for build in builds))
+
+        log.err("wkl: Starting to update entry for %s(%s)" % (buildid, parent['buildid']))
+
+        page = yield self.getPage()
+        if not page:
+            log.err("wkl: Unexpected content retrieved from wiki!")
             return False
 
-        new_entry = '\n' + entry.strip() + logentry + '\n\n'
+        if page.count > 200:
+            # Archive off entries when the log becomes too long
+            archived = yield self.archiveEntries()
+            self.page = None
+            if not archived:
+                return False
 
         summary = 'Updating entry with failures in %s' % builder
         summary = summary + self.idstring
 
-        new_entry, new_title = self.updateEntryBuildInfo(new_entry, title, parent)
+        # Other masters write to the same page, if one of them changes it
+        # between reading the entry and editing it start over from the
+        # current page
+        for attempt in range(self.EDIT_TRIES):
+            page, page_entry, text, timestamps = yield self.findEntry(parent)
+            if not page_entry:
+                errmsg = ("wkl: Failed to update entry for {0} couldn't find a matching title containing url: {1}")
+                log.err(errmsg.format(buildid, parent['url']))
+                return False
 
-        # If unchanged, skip the update
-        if entry == new_entry and title == new_title:
-            log.msg("wkl: Entry unchanged for wikilog entry %s" % buildid)
-            return True
+            # Drop the rest of the title line
+            title = page_entry.title
+            entry = text.split('\n', 1)[1] if '\n' in text else ''
 
-        # Find the point where the first entry's title starts and the second
-        # entry's title begins, then replace the text between those points
-        # with the newly generated entry.
-        it = re.finditer('\=\=\[(.+)\]\=\=', entries)
-        entry_title = next(it)
-        while entry_title.group(1) != title:
-            entry_title = next(it)
-        head = entries[:entry_title.start()]
-        try:
-            next_title = next(it)
-            tail = entries[next_title.start():]
-        except StopIteration:
-            # There was no following entry
-            tail = ""
+            new_entry = '\n' + entry.strip() + logentry + '\n\n'
 
-        update = blurb + head + "==[" + new_title + "]==\n" + new_entry + tail + footer
+            new_entry, new_title = self.updateEntryBuildInfo(new_entry, title, parent)
 
-        cookies = self.wiki.login()
-        if not cookies:
-            log.err("wkl: Failed to login to wiki")
-            return False
+            # If unchanged, skip the update
+            if entry == new_entry and title == new_title:
+                log.msg("wkl: Entry unchanged for wikilog entry %s" % buildid)
+                return True
 
-        post = self.wiki.post_entry(self.wiki_page, update, summary, cookies)
-        if not post:
-            log.err("wkl: Failed to update entry for %s(%s)" % (buildid, parent['buildid']))
-            return False
+            # Only replace the text of the entry's own section
+            update = "==[" + new_title + "]==\n" + new_entry
 
-        log.msg("wkl: Updating wikilog entry for %s(%s)" % (buildid, parent['buildid']))
-        return True
+            cookies = yield self.wiki.login()
+            if not cookies:
+                log.err("wkl: Failed to login to wiki")
+                return False
+
+            try:
+                post = yield self.wiki.edit_section(self.wiki_page, page.section(page_entry), summary,
+                                                    cookies, text=update, **timestamps)
+            except EditConflict:
+                log.msg("wkl: Edit conflict updating entry for %s(%s), retrying" % (buildid, parent['buildid']))
+                self.page = None
+                continue
+            if not post:
+                self.page = None
+                log.err("wkl: Failed to update entry for %s(%s)" % (buildid, parent['buildid']))
+                return False
+            page_entry.title = new_title
+
+            log.msg("wkl: Updating wikilog entry for %s(%s)" % (buildid, parent['buildid']))
+            return True
+
+        log.err("wkl: Gave up updating entry for %s(%s) after repeated edit conflicts" % (buildid, parent['buildid']))
+        return False
@@ -354,6 +354,13 @@ wait_full = ourTriggerable(name="wait-full",
                          builderNames=builderNamesFromConfigFull)
 schedulers.append(wait_full)
 
+# the post-trigger phase of split parent builds, triggered by the PostTrigger
+# service once the parent's children have finished
+if config.split_parent_builds:
+    for parent in ["a-quick", "a-full"]:
+        schedulers.append(ourTriggerable(name=parent + "-posttrigger",
+                                         builderNames=[parent + "-posttrigger"]))
+
 def parent_scheduler(target):
     return sched.ForceScheduler(
     name=target,
@@ -5,10 +5,28 @@
 from buildbot.plugins import reporters
 
 from yoctoabb import config
+from yoctoabb.reporters import buildhistory, janitor, posttrigger
 
 
 services = []
 
+# Build and step duration history, used for prioritising builders and to
+# predict when builds finish
+services.append(buildhistory.BuildHistory())
+
+# Data API endpoints serving the predicted ETAs, queue wait percentiles and
+# the state of quarantined workers
+if config.data_api_endpoints:
+    from yoctoabb.reporters import dataapi
+    services.append(dataapi.DataApiEndpoints())
+
+# Removes shared repo directories left behind by builds which didn't finish
+services.append(janitor.SharedRepoJanitor())
+
+# Runs the post-trigger steps of a-quick/a-full when split_parent_builds is set
+if config.split_parent_builds:
+    services.append(posttrigger.PostTrigger())
+
 # TODO: we'll replace this with functionality in yocto-autobuilder-helpers
 # to mail the error reports to the list
 # services.append(
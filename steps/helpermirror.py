@@ -0,0 +1,47 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.plugins import util
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS, FAILURE
+from twisted.internet import defer
+from twisted.python import log
+
+from yoctoabb.lib.helpermirror import mirror
+
+
+@util.renderer
+def get_helper_bundle(props):
+    return mirror.bundlePath(props.getProperty("helper_revision"))
+
+
+class PinHelperRevision(buildstep.BuildStep):
+    """
+    Pin the yocto-autobuilder-helper revision this build (and any builds it
+    triggers) uses in the helper_revision property and make sure the
+    master's mirror has a bundle of it to send to the worker. Builds given a
+    revision by their parent keep it, 'refresh' makes the mirror fetch from
+    the remote server first.
+    """
+    name = "Pin yocto-autobuilder-helper revision"
+
+    def __init__(self, refresh=False, **kwargs):
+        self.refresh = refresh
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        revision = self.getProperty("helper_revision")
+        try:
+            if revision and not self.refresh:
+                yield mirror.ensureBundle(revision)
+            else:
+                revision = yield mirror.pin(force=self.refresh)
+        except Exception as e:
+            log.err(e, "Couldn't pin the yocto-autobuilder-helper revision")
+            self.descriptionDone = ["Couldn't pin helper revision"]
+            return FAILURE
+        self.setProperty("helper_revision", revision, self.name)
+        self.descriptionDone = ["Pinned helper", revision[:12]]
+        return SUCCESS
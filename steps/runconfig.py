@@ -107,10 +107,19 @@ def get_sstate_release_number(props):
     release_components = release_number.split('.', 3)
     return '.'.join(release_components).strip('.')
 
+@util.renderer
+def get_parent_buildername(props):
+    """
+    The builder whose configuration applies to this build. When the
+    post-trigger phase of a parent build runs as a build of its own (see
+    config.split_parent_builds) this is the parent's builder.
+    """
+    return props.getProperty("yp_parent_buildername", props.getProperty("buildername"))
+
 def get_runconfig_command(posttrigger=False):
     runconfig_command = [util.Interpolate("%(prop:builddir)s/yocto-autobuilder-helper/scripts/run-config")]
     if posttrigger:
-        runconfig_command.append(util.Interpolate("%(prop:buildername)s-posttrigger"))
+        runconfig_command.append(util.Interpolate("%(kw:buildername)s-posttrigger", buildername=get_parent_buildername))
     else:
         runconfig_command.append(util.Property("buildername"))
     runconfig_command.extend([ 
@@ -0,0 +1,121 @@
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+from buildbot.plugins import util
+from buildbot.process import buildstep, logobserver
+from buildbot.process.results import SUCCESS
+from buildbot.steps import shell
+from twisted.internet import defer
+
+from yoctoabb import config
+from yoctoabb.lib import snapshots
+
+import os
+
+
+@util.renderer
+def get_sharedrepo_owner(props):
+    """
+    The parent build the shared repos belong to, the post-trigger phase of a
+    split parent build releases them on the parent's behalf
+    """
+    buildername = props.getProperty("yp_parent_buildername", props.getProperty("buildername"))
+    buildnumber = props.getProperty("yp_parent_buildnumber", props.getProperty("buildnumber"))
+    return "%s-%s" % (buildername, buildnumber)
+
+@util.renderer
+def get_sharedrepo_remove(props):
+    return ["rm", "-fr"] + props.getProperty("sharedrepo_remove", [])
+
+
+class AcquireSharedRepos(buildstep.BuildStep):
+    """
+    Decide where the shared repos of this build go. Builds whose
+    layerinfo.json pins every repo to a revision (see WriteLayerInfo's
+    layerinfo_hash) share a snapshot with any other build with the same
+    layerinfo, which only needs preparing if no build has done so yet.
+    Otherwise, for builds deploying their artefacts, or while another build
+    is still preparing the snapshot, the build gets a directory of its own
+    as before.
+
+    Sets sharedrepolocation, sharedrepo_snapshot (the hash or "") and
+    sharedrepo_prepare.
+    """
+    name = "Acquire shared repos"
+
+    @defer.inlineCallbacks
+    def run(self):
+        snaphash = self.getProperty("layerinfo_hash")
+        owner = yield self.build.render(get_sharedrepo_owner)
+        state = None
+        # prepare-shared-repos also publishes the repos for builds which
+        # deploy their artefacts, those always have to run it
+        if snaphash and not self.getProperty("deploy_artefacts", False):
+            state = snapshots.registry.acquire(snaphash, owner)
+
+        if state is None:
+            location = os.path.join(config.sharedrepodir, owner)
+            snaphash = ""
+            prepare = True
+            self.descriptionDone = ["Using %s" % owner]
+        else:
+            location = snapshots.registry.location(snaphash)
+            prepare = state == snapshots.PREPARING
+            self.descriptionDone = ["Preparing snapshot" if prepare else "Reusing snapshot", snaphash[:12]]
+
+        self.setProperty("sharedrepolocation", location, self.name)
+        self.setProperty("sharedrepo_snapshot", snaphash, self.name)
+        self.setProperty("sharedrepo_prepare", prepare, self.name)
+        return SUCCESS
+
+
+class MarkSharedReposReady(shell.ShellCommand):
+    """
+    Record a freshly prepared snapshot as ready for other builds to use,
+    along with its size for the garbage collection
+    """
+    name = "Mark shared repo snapshot ready"
+    command = ["du", "-sk", util.Interpolate("%(prop:sharedrepolocation)s")]
+    haltOnFailure = True
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("doStepIf", lambda step: step.getProperty("sharedrepo_prepare") and step.getProperty("sharedrepo_snapshot"))
+        super().__init__(*args, **kwargs)
+        self.log_observer = logobserver.BufferLogObserver()
+        self.addLogObserver('stdio', self.log_observer)
+
+    def evaluateCommand(self, cmd):
+        rc = super().evaluateCommand(cmd)
+        if rc == SUCCESS:
+            output = self.log_observer.getStdout().split()
+            size = int(output[0]) if output and output[0].isdigit() else 0
+            snapshots.registry.ready(self.getProperty("sharedrepo_snapshot"), size,
+                                    self.getProperty("sharedrepolocation"))
+        return rc
+
+
+class ReleaseSharedRepos(buildstep.BuildStep):
+    """
+    Drop this build's reference on its shared repo snapshot and work out
+    which directories can be removed, this build's own directory if it
+    didn't use a snapshot, otherwise whichever snapshots the garbage
+    collection evicted. Sets sharedrepo_remove.
+    """
+    name = "Release shared repos"
+    alwaysRun = True
+
+    @defer.inlineCallbacks
+    def run(self):
+        snaphash = self.getProperty("sharedrepo_snapshot")
+        location = self.getProperty("sharedrepolocation")
+        if snaphash:
+            owner = yield self.build.render(get_sharedrepo_owner)
+            remove = snapshots.registry.release(snaphash, owner)
+        elif location:
+            remove = [location]
+        else:
+            remove = []
+        self.setProperty("sharedrepo_remove", remove, self.name)
+        self.descriptionDone = ["Removing %d directories" % len(remove)]
+        return SUCCESS
@@ -4,8 +4,10 @@
 
 from twisted.internet import defer
 from buildbot.process import buildstep
+import hashlib
 import json
 import os
+import re
 
 from yoctoabb import config
 
@@ -18,7 +20,9 @@ class WriteLayerInfo(buildstep.ShellMixin, buildstep.BuildStep):
 
     def generateLayerInfo(self):
         layerinfo = {}
-        writerepos = config.buildertorepos.get(self.getProperty("buildername"))
+        # The post-trigger phase of a split parent build uses the parent's repos
+        buildername = self.getProperty("yp_parent_buildername", self.getProperty("buildername"))
+        writerepos = config.buildertorepos.get(buildername)
         if not writerepos:
             writerepos = config.buildertorepos["default"]
 
@@ -32,9 +36,21 @@ class WriteLayerInfo(buildstep.ShellMixin, buildstep.BuildStep):
         return json.dumps(layerinfo, sort_keys=True, indent=4,
                           separators=(',', ': '))
 
+    def layerInfoHash(self, repojson):
+        """
+        A hash identifying the layerinfo if every repo in it is pinned to a
+        full revision, otherwise the same layerinfo could yield different
+        content later and None is returned.
+        """
+        for repo in json.loads(repojson).values():
+            if not re.match(r"^[0-9a-f]{40}$", repo["revision"] or ""):
+                return None
+        return hashlib.sha256(repojson.encode("utf-8")).hexdigest()
+
     @defer.inlineCallbacks
     def run(self):
         repojson = self.generateLayerInfo()
+        self.setProperty("layerinfo_hash", self.layerInfoHash(repojson) or "", self.name)
         layerinfo = os.path.join(self.getProperty("builddir"),
                                  "layerinfo.json")
         writerepos = "printf '%s' > %s" % (repojson, layerinfo)
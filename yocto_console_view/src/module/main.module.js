@@ -99,9 +99,10 @@ class Console {
 
         this.$scope.revmapping = (this.revmapping = {});
         this.$scope.branchmapping = (this.branchmapping = {});
+        this.$scope.etamapping = (this.etamapping = {});
 
         this.$scope.builds = (this.builds = this.dataAccessor.getBuilds({
-            property: ["yp_build_revision", "yp_build_branch", "reason", "publish_destination"],
+            property: ["yp_build_revision", "yp_build_branch", "yp_eta", "reason", "publish_destination"],
             limit: this.buildLimit,
             order: '-started_at'
         }));
@@ -127,7 +128,10 @@ class Console {
                 this.branchmapping[build.buildid] = build.properties.yp_build_branch[0];
                 change = true;
             }
-            if ((!this.revmapping[buildid] || !this.branchmapping[buildid]) && !build.complete_at) {
+            if ((build.properties != null ? build.properties.yp_eta : undefined) != null) {
+                this.etamapping[build.buildid] = build.properties.yp_eta[0];
+            }
+            if ((!this.revmapping[buildid] || !this.branchmapping[buildid] || !this.etamapping[buildid]) && !build.complete_at) {
                 build.getProperties().onChange = properties => {
                     change = false;
                     buildid = properties.endpoint.split('/')[1];
@@ -145,6 +149,12 @@ class Console {
                             change = true;
                         }
                     }
+                    if (!this.etamapping[buildid]) {
+                        const eta = this.getBuildProperty(properties[0], 'yp_eta');
+                        if (eta != null) {
+                            this.etamapping[buildid] = eta;
+                        }
+                    }
                     if (change && (this.onchange_debounce == null)) {
                         this.onchange_debounce = this.$timeout(this._onChange, 100);
                     }
@@ -156,6 +166,15 @@ class Console {
         };
     }
 
+    // Tooltip for a build, with the expected finish time of running builds
+    buildTitle(builder, build) {
+        const eta = this.etamapping[build.buildid];
+        if (build.complete_at || (eta == null)) {
+            return builder.name;
+        }
+        return `${builder.name} - ETA ${new Date(eta * 1000).toLocaleTimeString()}`;
+    }
+
     getBuildProperty(properties, property) {
         const hasProperty = properties && properties.hasOwnProperty(property);
         if (hasProperty) { return properties[property][0]; } else { return null; }